@@ -0,0 +1,160 @@
+import asyncio
+import json
+import sys
+from urllib.parse import parse_qs
+
+from libs.extractive_summary import extractive_summary
+from libs.gcp_libs import generate_text, search_and_parse
+from libs.log import get_logger, start_request
+from libs.markup import SummaryTokenizer
+from libs.metrics import metrics
+from libs.prompt import build_prompt
+
+# 検索結果と要約を JSON で返す API（Flet の UI を通さない）
+#   hypercorn api:app --bind 0.0.0.0:8080 --workers 4
+#
+# GET /search?q=...     検索結果のみ（&page_token=... で meta.next_page_token の続き）
+# GET /summarize?q=...  検索結果 + 要約（生成に失敗したら検索結果の抽出回答から作った要約）
+# GET /metrics          Prometheus 形式のメトリクス
+
+logger = get_logger('api')
+
+
+def search(search_query: str, page_token: str = '') -> dict:
+    pd_result = search_and_parse(search_query, page_token=page_token)
+    return dict(
+        query=search_query,
+        meta=pd_result['meta'],
+        result=[_.to_dict() for _ in pd_result['result']],
+    )
+
+
+def summarize(search_query: str) -> dict:
+    # 要約は 1 ページ目の上位の結果から作る
+    response = search(search_query)
+    summary = ''
+    # model: 生成 AI モデルの要約、extractive: 検索結果の抽出回答から作った要約
+    summary_source = 'model'
+    if not response['result']:
+        # 検索結果が 0 件のときは生成しない（抜粋の要約は該当なしの文になる）
+        summary_source = 'extractive'
+    else:
+        try:
+            summary = generate_text(build_prompt(response, search_query))
+            # テキストが 1 つも返らなかった（安全性のフィルタなど）場合も抜粋の要約にする
+            reason = None if summary else 'EmptySummary'
+        except Exception as e:
+            logger.error('ERROR in summary: %s', e)
+            reason = type(e).__name__
+        if reason:
+            metrics.inc(
+                'summary_fallback_total',
+                '要約の生成に失敗して抜粋の要約を表示した回数',
+                reason=reason,
+            )
+            summary_source = 'extractive'
+    if summary_source == 'extractive':
+        summary = extractive_summary(response, search_query)
+    tokenizer = SummaryTokenizer()
+    tokenizer.feed(summary)
+    response.update(
+        summary=summary,
+        summary_source=summary_source,
+        # 太字かどうかと改行（text が "\n"）を解釈済みの要約
+        summary_spans=[dict(text=t, bold=b) for t, b in tokenizer.close()],
+        recommendations=tokenizer.recommendations or [],
+    )
+    return response
+
+
+_routes = {
+    '/search': search,
+    '/summarize': summarize,
+}
+
+
+async def _send_json(send, status: int, body: dict):
+    payload = json.dumps(body, ensure_ascii=False).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json; charset=utf-8'),
+            (b'content-length', str(len(payload)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _send_metrics(send):
+    # workers ごとのプロセスの値になる
+    payload = metrics.render().encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/plain; version=0.0.4; charset=utf-8'),
+            (b'content-length', str(len(payload)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI アプリケーション"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == '/metrics':
+        await _send_metrics(send)
+        return
+    handler = _routes.get(scope['path'])
+    if handler is None:
+        await _send_json(send, 404, {'error': 'Not found.'})
+        return
+    if scope['method'] != 'GET':
+        await _send_json(send, 405, {'error': 'Method not allowed.'})
+        return
+    params = parse_qs(scope.get('query_string', b'').decode())
+    search_query = (params.get('q') or [''])[0].strip()
+    page_token = (params.get('page_token') or [''])[0]
+    if not search_query:
+        await _send_json(send, 400, {'error': 'Specify query please.'})
+        return
+    # 要約は 1 ページ目から作るので、page_token は /search だけで受け付ける
+    args = (search_query,)
+    if page_token:
+        if handler is not search:
+            await _send_json(send, 400, {'error': 'page_token is only supported by /search.'})
+            return
+        args = (search_query, page_token)
+    # to_thread はコンテキストを引き継ぐので、スレッド内のログにも同じ ID が付く
+    start_request()
+    try:
+        # 検索・生成はブロッキングなのでスレッドで実行する
+        body = await asyncio.to_thread(handler, *args)
+    except Exception as e:
+        logger.error('ERROR in %s: %s', scope['path'], e)
+        await _send_json(send, 502, {'error': str(e)})
+        return
+    await _send_json(send, 200, body)
+
+
+if __name__ == "__main__":
+    query = sys.argv[1] if len(sys.argv) > 1 else "データ"
+    print(
+        json.dumps(search(query), ensure_ascii=False)
+    )
@@ -0,0 +1,65 @@
+"""同じクエリの検索が同時に来たときの上流へのリクエスト数を計測する（Google のサービスには接続しない）
+
+    python benchmarks/burst.py [--clients 20] [--search-latency 0.3] [--model-latency 2.0]
+
+イベントで多くの人が同じピックアップのボタンを押した状況を再現し、
+偽の検索サーバー・偽のモデルへのリクエスト数と、全員に要約が届くまでの時間を出力する。
+SINGLE_FLIGHT_ENABLED=0 で実行するとまとめない場合と比較できる。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks import stages  # noqa: E402
+from benchmarks.fakes import FakeModel  # noqa: E402
+from libs.prompt import build_prompt  # noqa: E402
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--spread', type=float, default=0.5, help='クリックがばらつく時間（秒）')
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--search-latency', type=float, default=0.3, help='検索の遅延（秒）')
+    parser.add_argument('--model-latency', type=float, default=2.0, help='生成の遅延（秒）')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='トークン発行の遅延（秒）')
+    args = parser.parse_args()
+
+    server, gcp_libs = stages.setup(args)
+    model = FakeModel(latency=args.model_latency, first_token_latency=args.model_latency / 4)
+    gcp_libs._load_model = lambda model_name=None: (model, None)
+
+    latencies = []
+
+    def click(delay: float):
+        time.sleep(delay)
+        started_at = time.perf_counter()
+        pd_result = gcp_libs.search_and_parse('ピックアップ')
+        for _ in gcp_libs.generate_text_stream(build_prompt(pd_result, 'ピックアップ')):
+            pass
+        latencies.append(time.perf_counter() - started_at)
+
+    threads = [
+        threading.Thread(target=click, args=(args.spread * i / max(args.clients - 1, 1),))
+        for i in range(args.clients)
+    ]
+    for _ in threads:
+        _.start()
+    for _ in threads:
+        _.join()
+    server.stop()
+
+    print(json.dumps(dict(
+        clients=args.clients,
+        search_requests=server.requests,
+        generate_requests=model.calls,
+        p50=round(stages.percentile(latencies, 50), 3),
+        max=round(max(latencies), 3),
+        search_flight=gcp_libs.search_flight.stats(),
+        summary_flight=gcp_libs.summary_flight.stats(),
+    ), indent=1))
@@ -0,0 +1,117 @@
+"""抜粋の要約（libs.extractive_summary）の性質の確認と、生成 AI モデルの要約との時間の比較（Google のサービスには接続しない）
+
+    python benchmarks/extractive.py [--iterations 2000] [--model-calls 5] [--model-latency 3.0]
+
+1. 性質の確認（満たさないものがあれば終了コード 1）
+   - 同じ入力には同じ要約を返す
+   - tokenize_summary の span のテキストにマークアップ（** や <br>、改行）が残らない
+   - 箇条書きの行ごとに企業名（またはファイルのタイトル）が太字になる
+   - 引用（… で省略したものを除く）は、抽出回答またはスニペットの本文にそのまま含まれる
+2. 1 回あたりの時間を、FakeModel（指定した遅延で返す）の generate_text_stream の最初の chunk・全体と比較する
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks import stages  # noqa: E402
+from benchmarks.fakes import FakeModel  # noqa: E402
+from libs.prompt import build_prompt  # noqa: E402
+
+_queries = ['データ分析', 'BigQuery 導入事例', '生成 AI', '需要予測', 'コスト削減', '']
+_re_bullet = re.compile(r'^- \*\*(.+?)\*\*: (?:「(.*)」)?.*（(.+)）。$')
+
+
+def check(pd_result: dict) -> list:
+    """性質を満たさない要約の説明のリスト"""
+    from libs.extractive_summary import _plain, extractive_summary
+    from libs.markup import NEWLINE, tokenize_summary
+    from libs.prompt import plain_snippet
+
+    errors = []
+    sources = [
+        _plain(entry.get('extractive_segment') or '') + '\n' + _plain(plain_snippet(entry))
+        for entry in pd_result['result'] if entry['title']
+    ]
+    for search_query in _queries:
+        summary = extractive_summary(pd_result, search_query)
+        if summary != extractive_summary(pd_result, search_query):
+            errors.append('not deterministic: {!r}'.format(search_query))
+        spans = tokenize_summary(summary)
+        for text, bold in spans:
+            if (text, bold) != NEWLINE and ('**' in text or '<br>' in text or '\n' in text):
+                errors.append('markup left: {!r}'.format(text))
+        bullets = [_ for _ in summary.split('\n') if _.startswith('- ')]
+        bold_names = [text for text, bold in spans if bold]
+        for i, line in enumerate(bullets):
+            match = _re_bullet.match(line)
+            if match is None:
+                errors.append('unexpected line: {!r}'.format(line))
+                continue
+            name, quote, _ = match.groups()
+            if name not in bold_names:
+                errors.append('name is not bold: {!r}'.format(name))
+            if quote and not quote.endswith('…') and quote not in sources[i]:
+                errors.append('quote not in source: {!r}'.format(quote))
+    return errors
+
+
+def measure_extractive(pd_result: dict, iterations: int) -> dict:
+    from libs.extractive_summary import extractive_summary
+
+    started_at = time.perf_counter()
+    for i in range(iterations):
+        extractive_summary(pd_result, _queries[i % len(_queries)])
+    return dict(us=round((time.perf_counter() - started_at) / iterations * 1e6, 1))
+
+
+def measure_model(gcp_libs, pd_result: dict, args) -> dict:
+    model = FakeModel(latency=args.model_latency, first_token_latency=args.first_token_latency)
+    gcp_libs._load_model = lambda model_name=None: (model, None)
+    firsts = []
+    totals = []
+    for i in range(args.model_calls):
+        # 要約のキャッシュが効かないようにクエリを変える
+        prompt = build_prompt(pd_result, '{} {}'.format(args.query, i))
+        started_at = time.perf_counter()
+        first = None
+        for _ in gcp_libs.generate_text_stream(prompt):
+            if first is None:
+                first = time.perf_counter() - started_at
+        firsts.append(first)
+        totals.append(time.perf_counter() - started_at)
+    return dict(
+        first_ms=round(sum(firsts) / len(firsts) * 1000, 1),
+        total_ms=round(sum(totals) / len(totals) * 1000, 1),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--model-calls', type=int, default=5)
+    parser.add_argument('--model-latency', type=float, default=3.0, help='生成が終わるまでの秒数')
+    parser.add_argument('--first-token-latency', type=float, default=1.0,
+                        help='最初の chunk が届くまでの秒数')
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--query', default='データ分析')
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, gcp_libs = stages.setup(args)
+    pd_result = gcp_libs.search_and_parse(args.query)
+    errors = check(pd_result)
+    result = dict(
+        errors=errors[:10],
+        extractive=measure_extractive(pd_result, args.iterations),
+        model=measure_model(gcp_libs, pd_result, args),
+    )
+    server.stop()
+    print(json.dumps(result, indent=1, ensure_ascii=False))
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,212 @@
+"""ベンチマーク用のローカルの代替（Discovery Engine / Gemini / 認証）"""
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+payloads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+# FakeModel が返す要約（clean_summary_text が解釈するマークアップに合わせる）
+fake_summary = '''検索結果によると、**データ分析基盤**について、下記企業の事例が挙げられます。
+- **株式会社サンプル商事**: 「BigQuery を活用して業務を効率化しました」（株式会社サンプル商事 導入事例）。
+- **ミライ物流株式会社**: 「処理時間を 40% 削減しました」（ミライ物流株式会社 導入事例）。
+- **あおぞら銀行**: 「分析により多くの時間を使えるようになりました」（あおぞら銀行 導入事例）。
+{"recommendations": ["需要予測", "BigQuery", "生成 AI"]}
+質問の意図とずれている場合は、遠慮なく別の表現で質問してくださいね。'''
+
+
+def load_payload(name: str = 'search_response.json') -> bytes:
+    with open(os.path.join(payloads_dir, name), 'rb') as f:
+        return f.read()
+
+
+def project_response(response: dict) -> dict:
+    """README の例の SEARCH_RESPONSE_FIELDS を指定したときに返るフィールドだけを残す"""
+    derived_keys = ('title', 'link', 'snippets', 'extractive_answers')
+    results = []
+    for r in response.get('results', []):
+        document = r.get('document', {})
+        projected = {}
+        if 'structData' in document:
+            projected['structData'] = document['structData']
+        if 'derivedStructData' in document:
+            projected['derivedStructData'] = {
+                k: v for k, v in document['derivedStructData'].items() if k in derived_keys
+            }
+        results.append({'document': projected})
+    projected = {'results': results}
+    for key in ('totalSize', 'attributionToken', 'nextPageToken'):
+        if key in response:
+            projected[key] = response[key]
+    return projected
+
+
+class FakeSearchServer:
+    """Discovery Engine の search と同じパスに、記録したレスポンスを返す HTTP サーバー
+
+    リクエストの pageSize / pageToken に合わせて、記録した results を分割して返す
+    fields が指定されていれば project_response と同じフィールドだけを返す
+    """
+
+    def __init__(self, payload: bytes, latency: float = 0.0):
+        self.payload = payload
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._pages = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # ヘッダーと本文を別々に送るので、Nagle で遅延しないようにする
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                fields = parse_qs(urlsplit(self.path).query).get('fields')
+                payload = server.page(
+                    body.get('pageSize'), body.get('pageToken', ''), bool(fields)
+                )
+                server.requests += 1
+                server.bytes_sent += len(payload)
+                if server.latency:
+                    time.sleep(server.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+
+    def page(self, page_size: int, page_token: str, projected: bool = False) -> bytes:
+        """pageToken は次のページの先頭の位置"""
+        key = (page_size, page_token, projected)
+        if key not in self._pages:
+            response = json.loads(self.payload)
+            results = response.get('results', [])
+            offset = int(page_token or 0)
+            size = page_size or len(results)
+            response['results'] = results[offset:offset + size]
+            response['nextPageToken'] = (
+                str(offset + size) if offset + size < len(results) else ''
+            )
+            if projected:
+                response = project_response(response)
+            self._pages[key] = json.dumps(response, ensure_ascii=False).encode()
+        return self._pages[key]
+
+    @property
+    def endpoint(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_port)
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+
+
+class _FakeUsage:
+    def __init__(self, prompt_token_count: int, cached_content_token_count: int,
+                 candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class _FakeResponse:
+    def __init__(self, text: str, usage_metadata: _FakeUsage = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeModel:
+    """GenerativeModel の代わり。決まった要約を、指定した遅延で返す
+
+    - latency: 生成が終わるまでの秒数
+    - first_token_latency: stream=True のときに最初の chunk が届くまでの秒数
+    - system_instruction / cached: GenerativeModel の system_instruction と、それをコンテキストキャッシュから読むか
+    - input_token_latency: 入力のトークン 1 つあたりの処理時間（キャッシュから読んだ分は含めない）
+
+    トークン数は libs.prompt.estimate_tokens で数え、usage_metadata（stream=True では最後の chunk）で返す
+    """
+
+    def __init__(self, text: str = fake_summary, latency: float = 0.0,
+                 first_token_latency: float = 0.0, chunk_size: int = 16,
+                 system_instruction: str = None, cached: bool = False,
+                 input_token_latency: float = 0.0):
+        self.text = text
+        self.latency = latency
+        self.first_token_latency = first_token_latency
+        self.chunk_size = chunk_size
+        self.system_instruction = system_instruction
+        self.cached = cached
+        self.input_token_latency = input_token_latency
+        self.calls = 0
+        # 呼び出しごとの usage_metadata
+        self.usages = []
+
+    def _usage(self, contents) -> _FakeUsage:
+        from libs.prompt import estimate_tokens
+
+        system_tokens = estimate_tokens(self.system_instruction or '')
+        usage = _FakeUsage(
+            system_tokens + sum(estimate_tokens(str(_)) for _ in contents),
+            system_tokens if self.cached else 0,
+            estimate_tokens(self.text),
+        )
+        self.usages.append(usage)
+        return usage
+
+    def _prefill(self, usage: _FakeUsage):
+        tokens = usage.prompt_token_count - usage.cached_content_token_count
+        time.sleep(tokens * self.input_token_latency)
+
+    def _stream(self, usage: _FakeUsage):
+        self._prefill(usage)
+        time.sleep(self.first_token_latency)
+        chunks = [
+            self.text[i:i + self.chunk_size]
+            for i in range(0, len(self.text), self.chunk_size)
+        ]
+        rest = max(self.latency - self.first_token_latency, 0) / max(len(chunks), 1)
+        for i, chunk in enumerate(chunks):
+            yield _FakeResponse(chunk, usage if i == len(chunks) - 1 else None)
+            time.sleep(rest)
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        self.calls += 1
+        usage = self._usage(contents)
+        if stream:
+            return self._stream(usage)
+        self._prefill(usage)
+        time.sleep(self.latency)
+        return _FakeResponse(self.text, usage)
+
+
+class FakeCredentials:
+    """service_account.Credentials の代わり。refresh() で 1 時間有効なトークンを発行する"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        time.sleep(self.latency)
+        self.token = 'fake-token-{}'.format(time.time())
+        self.expiry = (
+            datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            + datetime.timedelta(hours=1)
+        )
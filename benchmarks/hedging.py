@@ -0,0 +1,162 @@
+"""要約の生成の締め切り・ヘッジ・サーキットブレーカーの効果を計測する（Google のサービスには接続しない）
+
+    python benchmarks/hedging.py [--calls 120] [--concurrency 8]
+
+遅延とエラーを指定できる偽のモデル（先頭のモデル: pro、速いモデル: flash）で、以下を比較する。
+
+- slow_tail: pro の一部の呼び出しが遅い
+    - single: pro のみ、締め切りなし（以前の generate_text と同じ）
+    - hedged: 最初の chunk が hedge_delay までに届かなければ flash にも同時にリクエストする
+- outage: pro が全て失敗する
+    - failover: 失敗したら flash を呼ぶ（サーキットブレーカーなし）
+    - breaker: 連続して失敗した pro を呼ばずに flash を呼ぶ
+
+要約までの時間（total）と最初の chunk までの時間（first）の p50 / p95 / p99（秒）、採用したモデルと失敗の数を出力する。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks import stages  # noqa: E402
+from benchmarks.fakes import FakeModel, _FakeResponse  # noqa: E402
+
+_pro = 'gemini-1.5-pro-002'
+_flash = 'gemini-1.5-flash-002'
+
+
+class FlakyModel(FakeModel):
+    """呼び出しの一部が遅い・失敗する FakeModel（stream=True のみ）"""
+
+    def __init__(self, latency: float, slow_rate: float = 0.0, slow_latency: float = 0.0,
+                 error_rate: float = 0.0, error_latency: float = 0.0, seed: int = 0):
+        super().__init__(latency=latency, first_token_latency=latency / 3)
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.error_latency = error_latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _flaky_stream(self, latency: float, error: bool):
+        time.sleep(latency / 3)
+        if error:
+            time.sleep(max(self.error_latency - latency / 3, 0))
+            raise RuntimeError('503 Service Unavailable')
+        chunks = [
+            self.text[i:i + self.chunk_size]
+            for i in range(0, len(self.text), self.chunk_size)
+        ]
+        for chunk in chunks:
+            yield _FakeResponse(chunk)
+            time.sleep(latency * 2 / 3 / len(chunks))
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+        error = roll < self.error_rate
+        slow = not error and roll < self.error_rate + self.slow_rate
+        return self._flaky_stream(self.slow_latency if slow else self.latency, error)
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return round(values[min(int(len(values) * p), len(values) - 1)], 3)
+
+
+def run(gcp_libs, models: dict, policy: dict, args) -> dict:
+    from libs.generation_policy import GenerationPolicy
+
+    gcp_libs._load_model = lambda model_name=None: (models[model_name or _pro], None)
+    gcp_libs.generation_policy = GenerationPolicy(policy)
+    totals = []
+    firsts = []
+    failures = {}
+
+    def call(i):
+        started_at = time.perf_counter()
+        first = None
+        try:
+            # 要約のキャッシュ・同じプロンプトの合流が効かないようにプロンプトを変える
+            for _ in gcp_libs.generate_text_stream('benchmark {}'.format(i)):
+                if first is None:
+                    first = time.perf_counter() - started_at
+        except Exception as e:
+            failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+            return
+        totals.append(time.perf_counter() - started_at)
+        firsts.append(first)
+
+    calls = {name: model.calls for name, model in models.items()}
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(call, range(args.calls)))
+    return dict(
+        total=dict(p50=percentile(totals, 0.5), p95=percentile(totals, 0.95), p99=percentile(totals, 0.99)),
+        first=dict(p50=percentile(firsts, 0.5), p95=percentile(firsts, 0.95), p99=percentile(firsts, 0.99)),
+        succeeded=len(totals),
+        failures=failures,
+        model_calls={name: model.calls - calls[name] for name, model in models.items()},
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=120)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.3, help='pro の通常の生成時間（秒）')
+    parser.add_argument('--slow-rate', type=float, default=0.1, help='pro が遅くなる割合')
+    parser.add_argument('--slow-latency', type=float, default=3.0, help='pro が遅いときの生成時間（秒）')
+    parser.add_argument('--flash-latency', type=float, default=0.15, help='flash の生成時間（秒）')
+    parser.add_argument('--error-latency', type=float, default=1.0, help='pro が失敗するまでの時間（秒）')
+    parser.add_argument('--hedge-delay', type=float, default=0.3)
+    parser.add_argument('--deadline', type=float, default=2.0)
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--model-latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, gcp_libs = stages.setup(args)
+    base = dict(failure_threshold=5, reset_seconds=30)
+    slow_tail = lambda: {  # noqa: E731
+        _pro: FlakyModel(args.latency, args.slow_rate, args.slow_latency),
+        _flash: FlakyModel(args.flash_latency, seed=1),
+    }
+    outage = lambda: {  # noqa: E731
+        _pro: FlakyModel(args.latency, error_rate=1.0, error_latency=args.error_latency),
+        _flash: FlakyModel(args.flash_latency, seed=1),
+    }
+    result = dict(
+        slow_tail=dict(
+            single=run(gcp_libs, slow_tail(), dict(
+                base, models=[_pro], deadline=3600, hedge_delay=0,
+            ), args),
+            hedged=run(gcp_libs, slow_tail(), dict(
+                base, models=[_pro, _flash], deadline=args.deadline, hedge_delay=args.hedge_delay,
+            ), args),
+        ),
+        outage=dict(
+            single=run(gcp_libs, outage(), dict(
+                base, models=[_pro], deadline=3600, hedge_delay=0, failure_threshold=10 ** 9,
+            ), args),
+            failover=run(gcp_libs, outage(), dict(
+                base, models=[_pro, _flash], deadline=args.deadline, hedge_delay=args.hedge_delay,
+                failure_threshold=10 ** 9,
+            ), args),
+            breaker=run(gcp_libs, outage(), dict(
+                base, models=[_pro, _flash], deadline=args.deadline, hedge_delay=args.hedge_delay,
+            ), args),
+        ),
+    )
+    server.stop()
+    print(json.dumps(result, indent=1))
@@ -0,0 +1,232 @@
+"""libs.markup の性質の確認とスループットの計測
+
+    python benchmarks/markup.py [--cases 5000] [--seed 0] [--iterations 2000]
+
+1. 性質の確認（満たさないものがあれば終了コード 1）
+   - 要約らしいテキストのコーパスで、以前の clean_summary_text / clean_snippet_text と同じ結果になる
+   - ランダムな位置で分割して feed しても、まとめて解釈した結果と同じになる
+   - 任意の文字列で例外にならず、span のテキストは空でもマークアップ（** や <b>、改行）を含むものでもない
+2. スループット（1 秒あたりの文字数）を以前の実装と比較する
+"""
+import argparse
+import html
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks.fakes import fake_summary  # noqa: E402
+from libs.markup import (NEWLINE, SummaryTokenizer,  # noqa: E402
+                         tokenize_snippet, tokenize_summary)
+
+# 任意の文字列の確認では壊れたおすすめワードの行を大量に解釈するので、そのエラーログは出さない
+logging.getLogger('app.markup').setLevel(logging.CRITICAL)
+
+
+def legacy_clean_summary_text(summary_text: str) -> list:
+    """以前の clean_summary_text（比較用）"""
+    output = []
+    tmp = re.sub(r'。\s+?\-', '。-', summary_text)
+    tmp = tmp.replace('<br>', '')
+    tmp = re.sub(r'\(,+\)', '', tmp)
+    lines = tmp.replace('。-', '。\n-').split('\n')
+    for s in lines:
+        se = s.strip()
+        if s.startswith("- "):
+            se = '・' + se[2:]
+        if s.startswith('{"recommendations":'):
+            output.append('\n')
+            continue
+        if s == '':
+            continue
+        ss = se.split('**')
+        for i, _ in enumerate(ss):
+            if i % 2 == 1:
+                output.append('[BOLD]{}'.format(_))
+            else:
+                output.append(_)
+        output.append('\n')
+    while output and output[-1] in ('\n', ''):
+        output.pop(-1)
+    return output
+
+
+def legacy_clean_snippet_text(snippet_text: str) -> list:
+    """以前の clean_snippet_text（比較用）"""
+    tmp = html.unescape(snippet_text)
+    tmp = tmp.replace("\xa0", "")
+    return re.split(r'<\/*b>', tmp)
+
+
+def legacy_summary_as_spans(summary_text: str) -> list:
+    # 以前の形式（[BOLD] の接頭辞、空の文字列を含む）を span に揃える
+    spans = []
+    for token in legacy_clean_summary_text(summary_text):
+        if token == '\n':
+            spans.append(NEWLINE)
+        elif token.startswith('[BOLD]'):
+            if token[6:]:
+                spans.append((token[6:], True))
+        elif token:
+            spans.append((token, False))
+    return spans
+
+
+def legacy_snippet_as_spans(snippet_text: str) -> list:
+    return [
+        (text, i % 2 == 1)
+        for i, text in enumerate(legacy_clean_snippet_text(snippet_text))
+        if text
+    ]
+
+
+_words = [
+    '検索結果によると', 'データ分析基盤', 'BigQuery', '生成 AI', '株式会社サンプル商事',
+    '業務を効率化しました', '導入事例', '処理時間を 40% 削減', 'について', '下記企業の事例が挙げられます',
+]
+
+
+def random_summary(rng: random.Random) -> str:
+    """Gemini が出力する要約に近いテキスト"""
+    lines = []
+    for _ in range(rng.randint(1, 8)):
+        kind = rng.random()
+        words = rng.sample(_words, rng.randint(1, 4))
+        if rng.random() < 0.5:
+            i = rng.randrange(len(words))
+            words[i] = '**{}**'.format(words[i])
+        text = '、'.join(words)
+        if kind < 0.4:
+            line = '- ' + text + rng.choice(['。', '', '（{}）。'.format(rng.choice(_words))])
+        elif kind < 0.5:
+            # 。のあとに空白を挟んで - が続く（1 行に複数の箇条書き）
+            # （。と - の間に <br> や (,,) が入ることもある）
+            separator = rng.choice(['', ' ', '  ', '　', '<br>', '(,,)', '<br>(,)', ' <br>', '(,,) '])
+            line = text + '。' + separator + '- ' + rng.choice(_words) + '。'
+        elif kind < 0.55:
+            line = json.dumps({'recommendations': rng.sample(_words, 3)}, ensure_ascii=False)
+        elif kind < 0.6:
+            line = rng.choice(['', ' ', '\t'])
+        else:
+            line = text + rng.choice(['。', '<br>', '(,,,)', '。<br>', ''])
+        lines.append(rng.choice(['', ' ']) + line if kind >= 0.6 else line)
+    return rng.choice(['\n', '\n\n', '。\n', '。\n\n']).join(lines) + rng.choice(['', '\n', '\n\n'])
+
+
+def random_snippet(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 6)):
+        word = rng.choice(_words + ['&amp;', '&nbsp;', '&quot;', '...', ' '])
+        parts.append('<b>{}</b>'.format(word) if rng.random() < 0.3 else word)
+    return ''.join(parts)
+
+
+def random_text(rng: random.Random) -> str:
+    """マークアップの文字を多く含む任意の文字列"""
+    alphabet = ['*', '**', '-', '- ', '。', ' ', '\n', '<br>', '(', ',', ')', '{', '"', 'あ', 'a',
+                '{"recommendations":', '<b>', '</b>', '&', ';', '\xa0', '　']
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+
+
+def stream(text: str, rng: random.Random) -> tuple:
+    tokenizer = SummaryTokenizer()
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 20)
+        tokenizer.feed(text[i:i + n])
+        tokenizer.partial()
+        i += n
+    return tokenizer.close(), tokenizer.recommendations
+
+
+def check_properties(cases: int, seed: int) -> list:
+    rng = random.Random(seed)
+    failures = []
+
+    def fail(name, text, detail):
+        if len(failures) < 20:
+            failures.append('{}: {!r} {}'.format(name, text, repr(detail)[:300]))
+
+    corpus = [fake_summary] + [random_summary(rng) for _ in range(cases)]
+    for text in corpus:
+        spans = tokenize_summary(text)
+        legacy = legacy_summary_as_spans(text)
+        if spans != legacy:
+            fail('summary == legacy', text, (spans, legacy))
+        streamed, _ = stream(text, rng)
+        if streamed != spans:
+            fail('streamed == whole', text, (streamed, spans))
+
+    for _ in range(cases):
+        text = random_snippet(rng)
+        if tokenize_snippet(text) != legacy_snippet_as_spans(text):
+            fail('snippet == legacy', text, tokenize_snippet(text))
+
+    for _ in range(cases):
+        text = random_text(rng)
+        try:
+            spans = tokenize_summary(text)
+            snippet_spans = tokenize_snippet(text)
+        except Exception as e:
+            fail('no exception', text, repr(e))
+            continue
+        if spans and spans[-1] is NEWLINE:
+            fail('no trailing newline', text, spans)
+        for span in spans:
+            if span is not NEWLINE and (not span[0] or '\n' in span[0] or '**' in span[0]):
+                fail('summary span text', text, span)
+        for span in snippet_spans:
+            if not span[0] or '<b>' in span[0] or '</b>' in span[0]:
+                fail('snippet span text', text, span)
+        if stream(text, rng)[0] != spans:
+            fail('streamed == whole (any text)', text, spans)
+    return failures
+
+
+def throughput(fn, texts: list, iterations: int) -> float:
+    chars = sum(len(_) for _ in texts)
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            fn(text)
+    return chars * iterations / (time.perf_counter() - started_at)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cases', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    failures = check_properties(args.cases, args.seed)
+    for _ in failures:
+        print('FAILED {}'.format(_))
+
+    rng = random.Random(args.seed)
+    summaries = [fake_summary] + [random_summary(rng) for _ in range(20)]
+    snippets = [random_snippet(rng) for _ in range(20)]
+    iterations = max(args.iterations // 20, 1)
+
+    def chunked(text):
+        return stream(text, random.Random(0))
+
+    result = dict(
+        cases=args.cases,
+        failures=len(failures),
+        chars_per_second=dict(
+            summary_legacy=round(throughput(legacy_clean_summary_text, summaries, iterations)),
+            summary=round(throughput(tokenize_summary, summaries, iterations)),
+            summary_streamed=round(throughput(chunked, summaries, iterations)),
+            snippet_legacy=round(throughput(legacy_clean_snippet_text, snippets, iterations)),
+            snippet=round(throughput(tokenize_snippet, snippets, iterations)),
+        ),
+    )
+    print(json.dumps(result, indent=1))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,60 @@
+"""generate_text の呼び出しごとのモデル準備のコストを計測する
+
+    python benchmarks/model_overhead.py [--iterations 1000]
+
+- per_call: 呼び出しのたびに GenerativeModel と GenerationConfig を作る（以前の実装）
+- registry: ModelRegistry から共有のインスタンスを取り出す
+どちらもモデルへのリクエストは送らない。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.model_registry import ModelRegistry  # noqa: E402
+
+_model_name = 'gemini-1.5-pro-002'
+_config = dict(
+    temperature=0,
+    top_p=1,
+    top_k=32,
+    max_output_tokens=2048,
+)
+
+
+def per_call(iterations: int) -> float:
+    from vertexai.generative_models import GenerationConfig, GenerativeModel
+
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        GenerativeModel(_model_name)
+        GenerationConfig(**_config)
+    return (time.perf_counter() - started_at) / iterations
+
+
+def registry(iterations: int) -> float:
+    registry_ = ModelRegistry()
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        registry_.get(_model_name, _config)
+    return (time.perf_counter() - started_at) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    import vertexai
+    vertexai.init(
+        project=os.environ.get('FIRESTORE_PROJECT_ID', 'benchmark'),
+        location='us-west1',
+    )
+    result = dict(
+        per_call_us=per_call(args.iterations) * 1e6,
+        registry_us=registry(args.iterations) * 1e6,
+    )
+    print(json.dumps(result))
@@ -0,0 +1,204 @@
+"""検索 1 回の画面更新（page.update()）の回数・送信量・時間を計測する（ブラウザや Google のサービスには接続しない）
+
+    python benchmarks/page_updates.py [--searches 5] [--model-latency 0.5] [--results 100]
+
+main.py の main(page) を、送信するメッセージを数えるだけの Flet の接続で実行し、
+検索ボタンを押してから要約の表示が終わるまでの page.update() ごとに以下を集計する。
+
+- bytes: クライアントに送るメッセージ（JSON）のバイト数
+- seconds: page.update() にかかった時間（差分の計算とメッセージの作成）
+- controls: 更新後のページのコントロールの数
+- scroll_bytes: 検索結果の一覧を表示領域 1 つ分スクロールしたときに送るバイト数
+
+--results を指定すると、記録したレスポンスの results を繰り返して件数を増やし、1 回の検索でその件数を表示する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import flet as ft  # noqa: E402
+from flet_core.local_connection import LocalConnection  # noqa: E402
+from flet_core.protocol import (ClientActions, ClientMessage,  # noqa: E402
+                                CommandEncoder,
+                                PageCommandsBatchResponsePayload)
+
+from benchmarks import stages  # noqa: E402
+from benchmarks.fakes import FakeModel, load_payload  # noqa: E402
+
+
+class CountingConnection(LocalConnection):
+    """FletSocketServer と同じメッセージを作り、送信せずにサイズだけ記録する"""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send_commands(self, session_id, commands):
+        results = []
+        messages = []
+        for command in commands:
+            result, message = self._process_command(command)
+            if command.name in ['add', 'get']:
+                results.append(result)
+            if message:
+                messages.append(message)
+        if messages:
+            payload = json.dumps(
+                ClientMessage(ClientActions.PAGE_CONTROLS_BATCH, messages),
+                cls=CommandEncoder,
+                separators=(',', ':'),
+            )
+            self.sent.append(len(payload.encode()))
+        return PageCommandsBatchResponsePayload(results=results, error='')
+
+
+def count_controls(control) -> int:
+    children = control._get_children() if hasattr(control, '_get_children') else []
+    return 1 + sum(count_controls(_) for _ in children)
+
+
+def find(control, cls):
+    if isinstance(control, cls):
+        return control
+    for child in (control._get_children() if hasattr(control, '_get_children') else []):
+        found = find(child, cls)
+        if found is not None:
+            return found
+    return None
+
+
+def enlarge_payload(payload: bytes, count: int) -> bytes:
+    """results を繰り返して count 件にする"""
+    response = json.loads(payload)
+    results = response['results']
+    response['results'] = [results[i % len(results)] for i in range(count)]
+    return json.dumps(response, ensure_ascii=False).encode()
+
+
+def scroll(page, connection, loop) -> int:
+    """検索結果の一覧を表示領域 1 つ分スクロールして、送ったバイト数を返す"""
+    result_list = find(page, ft.ListView)
+    if result_list is None:
+        return 0
+    window = result_list.data['window']
+    data = json.dumps(dict(
+        t='update', p=window.pixels + window.viewport, minse=0,
+        maxse=window.count * window.item_extent, vd=window.viewport,
+        sd=window.viewport, dir=None, os=None, v=None,
+    ))
+    event = ft.ControlEvent(result_list.uid, 'onScroll', data, result_list, page)
+    sent = len(connection.sent)
+    # クライアントからのイベントと同じく Flet のハンドラ経由で呼ぶ
+    asyncio.run_coroutine_threadsafe(
+        result_list.on_scroll.get_handler()(event), loop
+    ).result()
+    deadline = time.perf_counter() + 1
+    while len(connection.sent) == sent and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    time.sleep(0.05)
+    return sum(connection.sent[sent:])
+
+
+def import_main():
+    """main.py を import する（最後の ft.app() でサーバーを起動しないようにする）"""
+    os.environ['WARMUP_ON_START'] = '0'
+    os.environ.pop('METRICS_PORT', None)
+    app = ft.app
+    ft.app = lambda *args, **kwargs: None
+    try:
+        import main
+    finally:
+        ft.app = app
+    return main
+
+
+def run(args) -> list:
+    server, gcp_libs = stages.setup(args)
+    model = FakeModel(
+        latency=args.model_latency,
+        first_token_latency=args.model_latency / 4,
+    )
+    gcp_libs._load_model = lambda model_name=None: (model, None)
+    # 検索履歴は Firestore の代わりに固定の値を返す
+    histories = [dict(query='ベンチマーク {}'.format(i), count=10 - i) for i in range(10)]
+    gcp_libs.history_snapshot.get_histories = lambda count=None: histories
+    gcp_libs.history_snapshot.get_histories_by_count = lambda count=None: histories
+    if args.results:
+        server.payload = enlarge_payload(load_payload(args.payload), args.results)
+        server._pages.clear()
+        gcp_libs.global_search_settings['retreive_count'] = args.results
+        gcp_libs.global_search_settings['display_count'] = args.results
+
+    main = import_main()
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    connection = CountingConnection()
+    page = ft.Page(connection, 'benchmark', loop, ThreadPoolExecutor())
+
+    timings = []
+    update = page.update
+
+    def timed_update(*controls):
+        started_at = time.perf_counter()
+        update(*controls)
+        timings.append(time.perf_counter() - started_at)
+
+    page.update = timed_update
+    main.main(page)
+
+    text_field = find(page, ft.TextField)
+    button = find(page, ft.ElevatedButton)
+    searches = []
+    for i in range(args.searches):
+        connection.sent.clear()
+        timings.clear()
+        text_field.value = 'ベンチマーク {}'.format(i % 3)
+        started_at = time.perf_counter()
+        button.on_click(None)
+        # 要約の生成が終わると検索欄が有効に戻る
+        while text_field.disabled:
+            time.sleep(0.005)
+        searches.append(dict(
+            seconds=round(time.perf_counter() - started_at, 3),
+            updates=len(timings),
+            bytes=sum(connection.sent),
+            max_update_bytes=max(connection.sent, default=0),
+            update_seconds=round(sum(timings), 4),
+            max_update_seconds=round(max(timings, default=0), 4),
+            controls=count_controls(page),
+            scroll_bytes=scroll(page, connection, loop),
+        ))
+    server.stop()
+    return searches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--searches', type=int, default=5)
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--search-latency', type=float, default=0.0, help='検索の遅延（秒）')
+    parser.add_argument('--model-latency', type=float, default=0.5, help='生成の遅延（秒）')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='トークン発行の遅延（秒）')
+    parser.add_argument('--results', type=int, default=0, help='1 回の検索で表示する件数（0 なら記録したレスポンスのまま）')
+    args = parser.parse_args()
+
+    searches = run(args)
+    # 1 回目は画像などの初回の送信を含むので 2 回目以降の平均も出す
+    rest = searches[1:] or searches
+    print(json.dumps(dict(
+        searches=searches,
+        mean=dict(
+            updates=sum(_['updates'] for _ in rest) / len(rest),
+            bytes=sum(_['bytes'] for _ in rest) / len(rest),
+            update_seconds=round(sum(_['update_seconds'] for _ in rest) / len(rest), 4),
+            controls=sum(_['controls'] for _ in rest) / len(rest),
+        ),
+    ), indent=1))
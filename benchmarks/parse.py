@@ -0,0 +1,82 @@
+"""記録した検索のレスポンスのデコードとパースを計測する（Google のサービスには接続しない）
+
+    python benchmarks/parse.py [--iterations 2000] [--payload search_response.json]
+
+以下を比較し、1 回あたりの時間（マイクロ秒）と、パースした結果が保持するメモリ（バイト）を出力する。
+
+- text_dict: 全フィールドのレスポンスを str に変換してから json.loads し、結果を dict で保持する（以前の方法）
+- bytes_slots: fields で絞ったレスポンスをバイト列のまま json.loads し、結果を SearchResult で保持する
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+for key in ['PROJECT_ID', 'FIRESTORE_PROJECT_ID', 'VERTEX_AI_SEARCH_ENGINE_ID']:
+    os.environ.setdefault(key, 'benchmark')
+os.environ.setdefault('VERTEX_AI_SEARCH_LOCATION', 'global')
+
+from benchmarks.fakes import load_payload, project_response  # noqa: E402
+from libs.gcp_libs import parse_result_by_curl  # noqa: E402
+
+
+def text_dict(payload: bytes) -> dict:
+    # requests の response.text と同じく、一度 str にしてから読む
+    pd_result = parse_result_by_curl(json.loads(payload.decode('utf-8')))
+    pd_result['result'] = [_.to_dict() for _ in pd_result['result']]
+    return pd_result
+
+
+def bytes_slots(payload: bytes) -> dict:
+    return parse_result_by_curl(json.loads(payload))
+
+
+def per_call_us(fn, payload: bytes, iterations: int) -> float:
+    for _ in range(min(iterations, 100)):
+        fn(payload)
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        fn(payload)
+    return (time.perf_counter() - started_at) / iterations * 1e6
+
+
+def retained_bytes(fn, payload: bytes) -> int:
+    """パースした結果（meta と result）を保持し続けるのに使うメモリ"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = fn(payload)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(_.size_diff for _ in after.compare_to(before, 'filename'))
+    del kept
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--payload', default='search_response.json')
+    args = parser.parse_args()
+
+    full = load_payload(args.payload)
+    projected = json.dumps(
+        project_response(json.loads(full)), ensure_ascii=False
+    ).encode()
+
+    result = dict(
+        payload_bytes=dict(full=len(full), projected=len(projected)),
+        text_dict=dict(
+            us_per_call=round(per_call_us(text_dict, full, args.iterations), 1),
+            retained_bytes=retained_bytes(text_dict, full),
+        ),
+        bytes_slots=dict(
+            us_per_call=round(per_call_us(bytes_slots, projected, args.iterations), 1),
+            retained_bytes=retained_bytes(bytes_slots, projected),
+        ),
+    )
+    print(json.dumps(result, indent=1))
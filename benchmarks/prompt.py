@@ -0,0 +1,103 @@
+"""プロンプトの組み立てと、生成 1 回あたりの入力トークン数・時間を計測する（Google のサービスには接続しない）
+
+    python benchmarks/prompt.py [--iterations 20] [--input-token-latency 0.0002]
+
+以下を FakeModel（入力トークン数に比例した処理時間を足す）で比較する。
+
+- legacy: 回答の条件をプロンプトの先頭に付けて毎回送る（以前の build_prompt）
+- system_instruction: 回答の条件を system_instruction で送り、プロンプトは検索クエリと検索結果（タイトルと URL）のみ
+- system_instruction_excerpts: system_instruction に加え、スニペットの抜粋も含める（PROMPT_SNIPPET_EXCERPTS=1）
+- context_cache: system_instruction をコンテキストキャッシュから読む（入力の処理に含めない）
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks import stages  # noqa: E402
+from benchmarks.fakes import FakeModel  # noqa: E402
+
+
+def legacy_build_prompt(pd_result: dict, count: int = 3) -> str:
+    """以前の build_prompt（比較用）"""
+    from libs.prompt import SYSTEM_INSTRUCTION
+
+    prompt = SYSTEM_INSTRUCTION.rsplit('\n', 1)[0] + (
+        '\nなお、検索結果のタイトルとURLは、===== で囲まれたプロンプト末尾にある。\n\n=====\n'
+    )
+    for entry in pd_result['result'][:count]:
+        prompt += '''
+                {}, {}
+'''.format(
+            entry['customer'] if entry['source'] == 'GOOGLE_DRIVE' else entry['title'],
+            entry['link'],
+        )
+    prompt += '\n====='
+    return prompt
+
+
+def run(gcp_libs, pd_result: dict, mode: str, args) -> dict:
+    from libs.prompt import SYSTEM_INSTRUCTION, build_prompt
+
+    model = FakeModel(
+        latency=args.model_latency,
+        system_instruction=None if mode == 'legacy' else SYSTEM_INSTRUCTION,
+        cached=mode == 'context_cache',
+        input_token_latency=args.input_token_latency,
+    )
+    gcp_libs._load_model = lambda model_name=None: (model, None)
+    build_seconds = 0
+    latencies = []
+    prompt_chars = 0
+    for i in range(args.iterations):
+        # 要約のキャッシュ・同じプロンプトの合流が効かないようにクエリを変える
+        search_query = '{} {}'.format(args.query, i)
+        started_at = time.perf_counter()
+        if mode == 'legacy':
+            prompt = legacy_build_prompt(pd_result) + '\n' + search_query
+        else:
+            prompt = build_prompt(
+                pd_result, search_query,
+                snippet_excerpts=mode == 'system_instruction_excerpts',
+            )
+        build_seconds += time.perf_counter() - started_at
+        prompt_chars += len(prompt)
+        started_at = time.perf_counter()
+        gcp_libs.generate_text(prompt)
+        latencies.append(time.perf_counter() - started_at)
+    usages = model.usages
+    return dict(
+        build_us=round(build_seconds / args.iterations * 1e6, 1),
+        prompt_chars=prompt_chars // args.iterations,
+        input_tokens=sum(_.prompt_token_count for _ in usages) // len(usages),
+        processed_input_tokens=sum(
+            _.prompt_token_count - _.cached_content_token_count for _ in usages
+        ) // len(usages),
+        generate_ms=round(sum(latencies) / len(latencies) * 1000, 1),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--query', default='データ分析')
+    parser.add_argument('--model-latency', type=float, default=0.0, help='生成の遅延（秒）')
+    parser.add_argument('--input-token-latency', type=float, default=0.0002,
+                        help='入力のトークン 1 つあたりの処理時間（秒）')
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, gcp_libs = stages.setup(args)
+    pd_result = gcp_libs.search_and_parse(args.query)
+    result = {
+        mode: run(gcp_libs, pd_result, mode, args)
+        for mode in ['legacy', 'system_instruction', 'system_instruction_excerpts', 'context_cache']
+    }
+    server.stop()
+    print(json.dumps(result, indent=1))
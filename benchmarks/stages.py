@@ -0,0 +1,194 @@
+"""検索の流れを段階ごとに計測する（Google のサービスには接続しない）
+
+    python benchmarks/stages.py [--iterations 200] [--baseline benchmarks/baseline.json]
+
+get_token -> exec_search_by_curl -> parse_result_by_curl -> build_prompt -> generate_text
+-> clean_summary_text -> add_or_update_entry を実際のコードで実行し、
+段階ごと・全体の p50 / p95 / p99（ミリ秒）を出力する。
+
+- 検索: 記録したレスポンスを返すローカルの HTTP サーバー（benchmarks/payloads/）
+- 生成: 遅延を指定できる FakeModel
+- 認証: FakeCredentials（トークンのキャッシュのコードはそのまま使う）
+- Firestore: FIRESTORE_EMULATOR_HOST が設定されていればエミュレータへの書き込み（history_flush）も計測する
+
+--baseline を指定すると、p95 が基準値から許容範囲を超えて遅くなった段階があれば終了コード 1 になる。
+--save-baseline で今回の結果を基準値として保存する。
+
+基準値はミリ秒なので、計測したマシンの速さに依存する。固定の処理（calibration）の時間も一緒に保存し、
+比較するときは基準値をその比で補正する。それでも環境が大きく違う場合は、そのマシンで基準値を作り直すこと。
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from benchmarks.fakes import (FakeCredentials, FakeModel,  # noqa: E402
+                              FakeSearchServer, load_payload)
+from libs.prompt import build_prompt  # noqa: E402
+
+stage_names = [
+    'token',
+    'search',
+    'parse',
+    'prompt_build',
+    'generate',
+    'summary_clean',
+    'history_write',
+    'history_flush',
+    'end_to_end',
+]
+
+
+def percentile(values: list, p: float) -> float:
+    """nearest-rank 法のパーセンタイル"""
+    values = sorted(values)
+    k = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def setup(args):
+    """偽のサーバー・モデルを用意して libs.gcp_libs を import する"""
+    server = FakeSearchServer(
+        load_payload(args.payload), latency=args.search_latency
+    ).start()
+    # 設定は import 時に読まれるので、先に環境変数を入れておく
+    os.environ.update({
+        'DISCOVERY_ENGINE_ENDPOINT': server.endpoint,
+        'SEARCH_CACHE_ENABLED': '0',
+        'SUMMARY_CACHE_ENABLED': '0',
+        # エミュレータが無い場合は計測中に書き込みが走らないようにする
+        'QUERY_COUNTER_FLUSH_INTERVAL': '3600',
+        'QUERY_COUNTER_MAX_PENDING': '1000000',
+    })
+    for key in ['PROJECT_ID', 'FIRESTORE_PROJECT_ID', 'VERTEX_AI_SEARCH_ENGINE_ID']:
+        os.environ.setdefault(key, 'benchmark')
+    os.environ.setdefault('VERTEX_AI_SEARCH_LOCATION', 'global')
+
+    import libs.gcp_libs as gcp_libs
+    import libs.gcp_token as gcp_token
+
+    gcp_token._manager._build_credentials = lambda: FakeCredentials(args.token_latency)
+    model = FakeModel(latency=args.model_latency)
+    gcp_libs._load_model = lambda model_name=None: (model, None)
+    return server, gcp_libs
+
+
+def run_once(gcp_libs, search_query: str, with_flush: bool) -> dict:
+    timings = {}
+
+    def timed(name, fn, *fn_args):
+        started_at = time.perf_counter()
+        result = fn(*fn_args)
+        timings[name] = (time.perf_counter() - started_at) * 1000
+        return result
+
+    started_at = time.perf_counter()
+    timed('token', gcp_libs.get_token)
+    search_response = timed('search', gcp_libs.exec_search_by_curl, search_query)
+    pd_result = timed('parse', gcp_libs.parse_result_by_curl, search_response)
+    prompt = timed('prompt_build', build_prompt, pd_result, search_query)
+    summary = timed('generate', gcp_libs.generate_text, prompt)
+    timed('summary_clean', gcp_libs.clean_summary_text, summary)
+    timed('history_write', gcp_libs.add_or_update_entry, search_query)
+    if with_flush:
+        timed('history_flush', gcp_libs.query_counter.flush)
+    timings['end_to_end'] = (time.perf_counter() - started_at) * 1000
+    return timings
+
+
+def summarize(samples: dict) -> dict:
+    result = {}
+    for name in stage_names:
+        values = samples.get(name)
+        if not values:
+            continue
+        result[name] = dict(
+            p50=round(percentile(values, 50), 3),
+            p95=round(percentile(values, 95), 3),
+            p99=round(percentile(values, 99), 3),
+        )
+    return result
+
+
+def calibrate(payload: bytes, rounds: int = 21) -> float:
+    """マシンの速さの目安として、固定の処理（JSON の decode と SHA-256）の時間の中央値（ミリ秒）を返す"""
+    times = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        for _ in range(10):
+            json.loads(payload)
+            hashlib.sha256(payload).digest()
+        times.append((time.perf_counter() - started_at) * 1000)
+    return round(sorted(times)[rounds // 2], 3)
+
+
+def compare(result: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """基準値より遅くなった段階の一覧
+
+    両方に calibration があれば、基準値をマシンの速さの比で補正してから比べる
+    """
+    scale = 1.0
+    if 'calibration' in result and 'calibration' in baseline:
+        scale = result['calibration']['ms'] / baseline['calibration']['ms']
+    regressions = []
+    for name, stats in result.items():
+        base = baseline.get(name)
+        if not base or name == 'calibration':
+            continue
+        base_p95 = base['p95'] * scale
+        limit = max(base_p95 * (1 + tolerance), base_p95 + min_delta_ms)
+        if stats['p95'] > limit:
+            regressions.append(
+                '{}: p95 {:.3f}ms > {:.3f}ms (baseline {:.3f}ms x {:.2f})'.format(
+                    name, stats['p95'], limit, base['p95'], scale
+                )
+            )
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--payload', default='search_response.json')
+    parser.add_argument('--search-latency', type=float, default=0.0, help='検索の遅延（秒）')
+    parser.add_argument('--model-latency', type=float, default=0.0, help='生成の遅延（秒）')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='トークン発行の遅延（秒）')
+    parser.add_argument('--baseline', help='比較する基準値の JSON')
+    parser.add_argument('--save-baseline', help='今回の結果を基準値として保存する JSON')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='p95 の許容する増加率')
+    parser.add_argument('--min-delta-ms', type=float, default=2.0, help='許容する p95 の増加（ミリ秒）')
+    args = parser.parse_args()
+
+    server, gcp_libs = setup(args)
+    with_flush = bool(os.environ.get('FIRESTORE_EMULATOR_HOST'))
+    samples = {}
+    # ログは捨てる（キューに入れるまでのコストは計測に含める）
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(args.warmup + args.iterations):
+            timings = run_once(gcp_libs, 'ベンチマーク {}'.format(i % 50), with_flush)
+            if i < args.warmup:
+                continue
+            for name, value in timings.items():
+                samples.setdefault(name, []).append(value)
+    server.stop()
+
+    result = summarize(samples)
+    result['calibration'] = dict(ms=calibrate(load_payload(args.payload)))
+    print(json.dumps(result, indent=1))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=1)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.min_delta_ms)
+        for _ in regressions:
+            print('REGRESSION {}'.format(_))
+        sys.exit(1 if regressions else 0)
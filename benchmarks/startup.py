@@ -0,0 +1,115 @@
+"""起動時間を計測し、予算を超えたら失敗する
+
+    python benchmarks/startup.py [--import-budget 1.0] [--first-page-budget 5.0]
+
+- import: libs.gcp_libs と flet の import にかかる時間（別プロセスで計測）
+- first_page: python main.py を起動してから最初のページ（/）が 200 を返すまでの時間
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import するだけなら外部には接続しないので、未設定ならダミーの値を使う
+_dummy_env = {
+    'PROJECT_ID': 'benchmark',
+    'FIRESTORE_PROJECT_ID': 'benchmark',
+    'VERTEX_AI_SEARCH_LOCATION': 'global',
+    'VERTEX_AI_SEARCH_ENGINE_ID': 'benchmark',
+}
+
+_import_script = '''
+import time
+started_at = time.perf_counter()
+import flet
+import libs.gcp_libs
+print(time.perf_counter() - started_at)
+'''[1:]
+
+
+def _env(**kwargs) -> dict:
+    env = dict(_dummy_env)
+    env.update(os.environ)
+    env.update(kwargs)
+    env['PYTHONPATH'] = root
+    return env
+
+
+def measure_import() -> float:
+    output = subprocess.check_output(
+        [sys.executable, '-c', _import_script],
+        cwd=root,
+        env=_env(),
+    )
+    return float(output.decode().strip().split('\n')[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure_first_page(timeout: float = 60) -> float:
+    port = _free_port()
+    started_at = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, 'main.py'],
+        cwd=root,
+        env=_env(FLET_SERVER_PORT=str(port), WARMUP_ON_START='0'),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started_at < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError('main.py exited with {}'.format(proc.returncode))
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - started_at
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError('first page was not served in {}s'.format(timeout))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--import-budget', type=float,
+        default=float(os.environ.get('STARTUP_IMPORT_BUDGET', 1.0)),
+        help='import にかける時間の上限（秒）',
+    )
+    parser.add_argument(
+        '--first-page-budget', type=float,
+        default=float(os.environ.get('STARTUP_FIRST_PAGE_BUDGET', 5.0)),
+        help='最初のページを返すまでの時間の上限（秒）',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # 最も速かった回で比べる（ディスクキャッシュなどの揺らぎを除く）
+    result = dict(
+        import_seconds=min(measure_import() for _ in range(args.repeat)),
+        first_page_seconds=min(measure_first_page() for _ in range(args.repeat)),
+    )
+    print(json.dumps(result))
+    failed = False
+    if result['import_seconds'] > args.import_budget:
+        print('FAIL: import {:.3f}s > {:.3f}s'.format(result['import_seconds'], args.import_budget))
+        failed = True
+    if result['first_page_seconds'] > args.first_page_budget:
+        print('FAIL: first page {:.3f}s > {:.3f}s'.format(
+            result['first_page_seconds'], args.first_page_budget
+        ))
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,93 @@
+import os
+import re
+
+from libs.prompt import global_prompt_settings, plain_snippet
+
+# 検索結果の抜粋から作る要約の settings
+global_extractive_summary_settings = {
+    # 引用する 1 文の最大の文字数（超えたら … で省略する）
+    'max_quote_chars': int(os.environ.get('EXTRACTIVE_SUMMARY_MAX_CHARS', 80)),
+}
+
+# 文の区切り（。！？ の後）
+_re_sentence = re.compile(r'(?<=[。！？!?])')
+# 要約のマークアップとして解釈される文字列
+_re_markup = re.compile(r'\*\*|<br>|\(,+\)|\s+')
+# 拡張子
+_re_extension = re.compile(r'\.[A-Za-z0-9]{1,5}$')
+
+_no_results = '該当する結果を取得できませんでした、別の表現で質問してみてください'
+
+
+def _plain(text: str) -> str:
+    # マークアップ（** や改行など）と入れ子になる鉤括弧を除く
+    text = _re_markup.sub(lambda m: ' ' if m.group().isspace() else '', text or '')
+    return text.replace('「', '『').replace('」', '』').strip()
+
+
+def _bigrams(text: str) -> set:
+    text = ''.join(text.split())
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _sentences(entry) -> list:
+    """抽出回答（extractive answers）とスニペットの文。重複と途中で切れた文は除く"""
+    sentences = []
+    for source in [entry.get('extractive_segment') or '', plain_snippet(entry)]:
+        for sentence in _re_sentence.split(_plain(source)):
+            sentence = sentence.strip()
+            # スニペットの末尾の "..." は途中で切れている
+            if not sentence or sentence.endswith('...') or sentence in sentences:
+                continue
+            sentences.append(sentence)
+    return sentences
+
+
+def _quote(entry, query_bigrams: set) -> str:
+    """検索クエリと重なる文字が最も多い 1 文（同じなら先頭に近い文）"""
+    sentences = _sentences(entry)
+    if not sentences:
+        return ''
+    best = max(
+        enumerate(sentences),
+        key=lambda item: (len(query_bigrams & _bigrams(item[1])), -item[0]),
+    )[1]
+    max_chars = global_extractive_summary_settings['max_quote_chars']
+    if len(best) > max_chars:
+        best = best[:max_chars - 1] + '…'
+    # 文末の 。 は引用の外に付ける
+    return best.rstrip('。')
+
+
+def _name(entry) -> tuple:
+    """(太字にする名前, 出典)"""
+    if entry['source'] == 'GOOGLE_DRIVE':
+        # ドライブのファイルは企業名の代わりにファイルのタイトル（拡張子を除く）
+        title = _re_extension.sub('', _plain(entry['customer']))
+        return title, title
+    return _plain(entry['customer'] or entry['title']), _plain(entry['title'])
+
+
+def extractive_summary(pd_result: dict, search_query: str = '', count: int = None) -> str:
+    """上位の検索結果の抽出回答とスニペットから、モデルの要約と同じ形式の要約を作る
+
+    生成 AI モデルは使わず、同じ入力には同じ出力を返す。
+    「- **企業名**: 「引用」（出典）。」の行は libs.markup（clean_summary_text）でそのまま解釈できる
+    """
+    count = count or global_prompt_settings['result_count']
+    entries = [_ for _ in pd_result['result'] if _['title']][:count]
+    if not entries:
+        return _no_results
+    query_bigrams = _bigrams(_plain(search_query))
+    lines = ['検索結果によると、**{}**について、下記企業の事例が挙げられます。'.format(
+        _plain(search_query) or '検索ワード'
+    )]
+    for entry in entries:
+        name, source = _name(entry)
+        quote = _quote(entry, query_bigrams)
+        if quote:
+            lines.append('- **{}**: 「{}」（{}）。'.format(name, quote, source))
+        else:
+            lines.append('- **{}**: 詳細は検索結果を確認してください（{}）。'.format(name, source))
+    lines.append('詳細は検索結果を確認してください。')
+    return '\n'.join(lines)
@@ -0,0 +1,42 @@
+import os
+import threading
+
+# Firestore / Vertex AI の SDK は import と初期化に時間がかかり、コールドスタートが遅くなるので、
+# モジュールの先頭では import せず、初回に使うときに import してクライアントを作る
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def firestore_module():
+    """google.cloud.firestore を返す（FieldFilter や Increment などを使う関数の中で呼ぶ）"""
+    from google.cloud import firestore
+    return firestore
+
+
+def get_firestore_client():
+    """Firestore のクライアントを返す"""
+    client = _clients.get('firestore')
+    if client is None:
+        with _clients_lock:
+            if 'firestore' not in _clients:
+                _clients['firestore'] = firestore_module().Client(
+                    project=os.environ['FIRESTORE_PROJECT_ID']
+                )
+            client = _clients['firestore']
+    return client
+
+
+def init_vertexai():
+    """vertexai を初期化する（2 回目以降は何もしない）"""
+    if 'vertexai' in _clients:
+        return
+    with _clients_lock:
+        if 'vertexai' not in _clients:
+            import vertexai
+            vertexai.init(
+                project=os.environ['FIRESTORE_PROJECT_ID'],
+                location='us-west1',
+                # 未指定ならリージョンの既定のエンドポイントを使う
+                api_endpoint=os.environ.get('VERTEX_AI_API_ENDPOINT') or None,
+            )
+            _clients['vertexai'] = True
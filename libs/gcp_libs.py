@@ -2,21 +2,35 @@ import html
 import json
 import os
 import re
+import sqlite3
 import time
-from base64 import b64encode
-from typing import List
 
-import requests
-import vertexai
-from google.api_core.client_options import ClientOptions
-from google.cloud import discoveryengine_v1 as discoveryengine
-from google.cloud import firestore
-from vertexai.generative_models import GenerationConfig, GenerativeModel
-
-from libs.gcp_token import get_token
-
-client = firestore.Client(project=os.environ['FIRESTORE_PROJECT_ID'])
-vertexai.init(project=os.environ['FIRESTORE_PROJECT_ID'], location='us-west1')
+from libs.gcp_clients import get_firestore_client, init_vertexai
+from libs.gcp_token import get_token, get_token_stats
+from libs.gcp_transport import get_transport, get_transport_stats
+from libs.generation_policy import (GenerationPolicy,
+                                    global_generation_policy_settings)
+from libs.history_store import HistorySnapshot, global_history_settings
+from libs.log import get_logger, log_payload
+from libs.markup import parse_recommendations, tokenize_summary
+from libs.metrics import metrics
+from libs.model_registry import model_registry
+from libs.prompt import SYSTEM_INSTRUCTION
+from libs.query_counter import QueryCounter, global_query_counter_settings
+from libs.query_keys import normalize_query
+from libs.search_cache import TTLCache
+from libs.search_result import SearchResult
+from libs.single_flight import SingleFlight, global_single_flight_settings
+from libs.summary_cache import get_summary_cache, prompt_fingerprint
+
+logger = get_logger('gcp_libs')
+
+# 検索回数はメモリ上で集計してまとめて書き込む
+query_counter = QueryCounter(
+    get_firestore_client,
+    flush_interval_seconds=global_query_counter_settings['flush_interval_seconds'],
+    max_pending_queries=global_query_counter_settings['max_pending_queries'],
+)
 
 
 # プロジェクトID / ロケーション / 検索エンジンの ID を指定する
@@ -30,155 +44,81 @@ global_gcp_settings = dict(
 global_black_list = [
     '「事例の森」FAQ資料',
 ]
+_black_list = frozenset(global_black_list)
 
 # vertex_ai_search の settings
 global_search_settings = {
     'query_store_limit': 1000,
-    'retreive_count': 30,
-    'display_count': 20,
+    # 1 回の検索（1 ページ）で取得する件数。続きは next_page_token で取得する
+    'retreive_count': int(os.environ.get('SEARCH_PAGE_SIZE', 10)),
+    # 1 回の検索で表示する件数の上限（ページを読み足しても合計でこれを超えない）
+    'display_count': int(os.environ.get('SEARCH_DISPLAY_COUNT', 20)),
+    # レスポンスに含めるフィールド（fields パラメータ）。空（既定）なら全て返す
+    # derivedStructData の中まで絞れるかは実際のエンドポイントで確認してから指定すること
+    'response_fields': os.environ.get('SEARCH_RESPONSE_FIELDS', ''),
+}
+
+# 履歴は Firestore の listener で更新し、描画のたびには読まない
+history_snapshot = HistorySnapshot(
+    get_firestore_client,
+    limit=global_search_settings['query_store_limit'],
+    mode=global_history_settings['mode'],
+    refresh_interval_seconds=global_history_settings['refresh_interval_seconds'],
+    initial_wait_seconds=global_history_settings['initial_wait_seconds'],
+)
+
+# 検索結果のキャッシュの settings
+global_search_cache_settings = {
+    'enabled': os.environ.get('SEARCH_CACHE_ENABLED', '1') == '1',
+    'maxsize': int(os.environ.get('SEARCH_CACHE_MAXSIZE', 512)),
+    'ttl_seconds': float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', 600)),
 }
 
+search_cache = TTLCache(
+    maxsize=global_search_cache_settings['maxsize'],
+    ttl=global_search_cache_settings['ttl_seconds'],
+)
+
 
 def get_histories_by_count(count: int = 100) -> []:
     """検索回数が多い順番に履歴を返す"""
-    query = client.collection("Queries").order_by(
-        "count", direction=firestore.Query.DESCENDING
-    ).limit(global_search_settings['query_store_limit'])
-
-    result = []
-    for entry in query.stream():
-        result.append(entry.to_dict())
-        count -= 1
-        if count == 0:
-            break
-    return result
+    return history_snapshot.get_histories_by_count(count)
 
 
 def get_histories(count: int = 10) -> []:
     # クエリの履歴を取得する
     # isPickUp: true - 優先的に取得する
     # isUserQuery: true - ユーザのクエリ（直近 N 件）
-    picked_ups = []
-    user_queries = []
-
-    query = client.collection("Queries").where(
-        filter=firestore.FieldFilter("isPickUp", "==", True)
-    ).limit(global_search_settings['query_store_limit'])
-    for entry in query.stream():
-        picked_ups.append(entry.to_dict())
-        count -= 1
-
-    query = client.collection("Queries").order_by(
-        "updatedAt", direction=firestore.Query.DESCENDING
-    ).limit(global_search_settings['query_store_limit'])
-
-    for entry in query.stream():
-        dict_ = entry.to_dict()
-        if dict_.get('isPickUp'):
-            continue
-        # 同じクエリが 2 件表示されないようにする
-        if dict_.get('query') in [_['query'] for _ in picked_ups]:
-            continue
-        user_queries.append(dict_)
-        count -= 1
-        if count == 0:
-            break
-    return picked_ups + user_queries
+    return history_snapshot.get_histories(count)
 
 
 def add_or_update_entry(search_query: str):
-    col = client.collection("Queries")
-    b64_encoded_query = b64encode(search_query.encode()).decode()
-    query = col.where(
-        filter=firestore.FieldFilter("base64dQuery", "==", b64_encoded_query)
-    )
-    id = None
-    for entry in query.stream():
-        id = entry.id
-    # すでにあるクエリなら更新する
-    if id:
-        # エントリが存在していれば、1 回検索されたということ
-        dict_ = col.document(id).get().to_dict()
-        count = dict_.get('count', 1)
-        count += 1
-        col.document(id).update(
-            dict(
-                count=count,
-                updatedAt=int(time.time()),
-            )
-        )
-        return
-    # クエリをストレージに格納する
-    now_ = int(time.time())
-    data = {
-        'isUserQuery': True,
-        'query': search_query,
-        'base64dQuery': b64encode(search_query.encode()).decode(),
-        'createdAt': now_,
-        'updatedAt': now_,
-        'count': 0,
-    }
-    client.collection("Queries").document().set(data)
+    """検索回数を加算する。Firestore への書き込みはバックグラウンドでまとめて行う"""
+    query_counter.add(search_query)
+
+
+def get_query_counter_stats() -> dict:
+    """検索回数の書き込みの統計を返す"""
+    return query_counter.stats()
 
 
 def get_recommendations(summary_text: str) -> [str]:
     """Gemini からのおすすめワードを解釈する"""
-    output = []
-    try:
-        lines = summary_text.split('\n')
-        tmp = {}
-        for i, s in enumerate(lines):
-            if s.startswith('{"recommendations":'):
-                tmp = json.loads(str(s))
-                break
-            else:
-                continue
-        output = tmp.get('recommendations') or []
-    except Exception as e:
-        print('ERROR in recommendations: {}'.format(e))
-    return output
+    for line in summary_text.split('\n'):
+        if line.startswith('{"recommendations":'):
+            return parse_recommendations(line)
+    return []
 
 
-def clean_summary_text(summary_text: str) -> str:
-    """太字や行頭のドットのマークアップを解釈する"""
-    output = []
-    try:
-        # 。と-の間のスペースを除去する
-        tmp = re.sub(r'。\s+?\-', '。-', summary_text)
-        # <br> タグを除去する
-        tmp = tmp.replace('<br>', '')
-        # (,,,,) を除去する
-        tmp = re.sub(r'\(,+\)', '', tmp)
-        # 。と- が並んでいたら改行コードを挿入する
-        lines = tmp.replace('。-', '。\n-').split('\n')
-        for s in lines:
-            se = s.strip()
-            if s.startswith("- "):
-                se = '・' + se[2:]
-            # { から始まる行は除外する
-            if s.startswith('{"recommendations":'):
-                output.append('\n')
-                continue
-            # 何も無い行は除外する
-            if s == '':
-                continue
-            ss = se.split('**')
-            for i, _ in enumerate(ss):
-                if i % 2 == 1:
-                    output.append('[BOLD]{}'.format(_))
-                else:
-                    output.append(_)
-            output.append('\n')
-        # 最後のエントリの改行や空行を削除する
-        while True:
-            if output[-1] in ('\n', ''):
-                output.pop(-1)
-            else:
-                break
-        # print(output)
-    except Exception as e:
-        print('ERROR:{}'.format(str(e)))
-    return output
+def clean_summary_text(summary_text: str) -> list:
+    """太字や行頭のドットのマークアップを解釈する
+
+    太字は [BOLD] から始まる文字列、改行は '\n' のリストを返す（span は libs.markup を使う）
+    """
+    return [
+        '[BOLD]' + text if bold else text
+        for text, bold in tokenize_summary(summary_text)
+    ]
 
 
 def clean_snippet_text(snippet_text: str) -> list:
@@ -194,8 +134,73 @@ def clean_snippet_text(snippet_text: str) -> list:
     return re.split(r'<\/*b>', tmp)
 
 
+def _search_cache_key(search_query: str, page_token: str = '') -> tuple:
+    # 検索結果に影響する設定もキーに含める
+    return (
+        normalize_query(search_query),
+        page_token,
+        global_search_settings['retreive_count'],
+        global_search_settings['display_count'],
+        tuple(global_black_list),
+    )
+
+
+def _count_cache(cache: str, hit: bool):
+    metrics.inc(
+        'cache_requests_total',
+        'キャッシュの参照回数',
+        cache=cache,
+        result='hit' if hit else 'miss',
+    )
+
+
+# 同じクエリの検索・要約の生成が同時に来たら 1 回だけ実行して結果を共有する
+search_flight = SingleFlight('search')
+summary_flight = SingleFlight('summary')
+
+
+def search_and_parse(search_query: str, use_cache: bool = True, page_token: str = '') -> dict:
+    """検索してパースした結果を返す。同じクエリの結果はキャッシュから返す
+
+    page_token に前の結果の meta['next_page_token'] を渡すと次のページを返す
+    返り値はセッション間で共有されるので、呼び出し側で変更しないこと
+    """
+    use_cache = use_cache and global_search_cache_settings['enabled']
+    key = _search_cache_key(search_query, page_token)
+    if use_cache:
+        cached = search_cache.get(key)
+        _count_cache('search', cached is not None)
+        if cached is not None:
+            return cached
+
+    def search_uncached():
+        search_response = exec_search_by_curl(search_query, page_token=page_token)
+        with metrics.span('parse'):
+            pd_result = parse_result_by_curl(search_response)
+        # 実行中の検索が終わる前にキャッシュに入れ、後から来た呼び出しはキャッシュから返す
+        # （検索やパースに失敗したときは例外になるので、成功した結果だけが入る）
+        if use_cache:
+            search_cache.set(key, pd_result)
+        return pd_result
+
+    if not global_single_flight_settings['enabled']:
+        return search_uncached()
+    return search_flight.do(key, search_uncached)
+
+
+def invalidate_search_cache():
+    """検索結果のキャッシュを全て破棄する"""
+    search_cache.clear()
+
+
+def get_search_cache_stats() -> dict:
+    """検索結果のキャッシュのヒット数・ミス数などを返す"""
+    return search_cache.stats()
+
+
 def exec_search_by_curl(
     search_query: str,
+    page_token: str = '',
 ) -> dict:
     # needed valuables
     project_id = global_gcp_settings['project_id']
@@ -203,9 +208,10 @@ def exec_search_by_curl(
     engine_id = global_gcp_settings['engine_id']
 
     # retreive token
-    token = get_token()
+    with metrics.span('token'):
+        token = get_token()
 
-    url = "https://discoveryengine.googleapis.com/v1alpha/projects/{project_id}/locations/{locations}/collections/default_collection/engines/{engine_id}/servingConfigs/default_search:search".format(
+    path = "/v1alpha/projects/{project_id}/locations/{locations}/collections/default_collection/engines/{engine_id}/servingConfigs/default_search:search".format(
         project_id=project_id,
         locations=location,
         engine_id=engine_id,
@@ -224,147 +230,366 @@ def exec_search_by_curl(
             "extractiveContentSpec": {"maxExtractiveAnswerCount": 1}
         }
     }
+    if page_token:
+        # 2 ページ目以降（query などは 1 ページ目と同じにする必要がある）
+        data["pageToken"] = page_token
+
+    # パースで使うフィールドだけを返してもらう
+    params = {}
+    if global_search_settings['response_fields']:
+        params['fields'] = global_search_settings['response_fields']
+
+    with metrics.span('search'):
+        response = get_transport().post(path, headers=headers, params=params, json=data)
+        # 全文の出力はサンプリングしたリクエストのみ（他は先頭だけ）
+        log_payload(
+            logger, 'search response', response.content,
+            status=response.status_code, query=search_query,
+        )
+        # リトライしても 429 / 5xx のまま、または 401 / 403 などはエラーのレスポンスを結果として読まない
+        response.raise_for_status()
+        # response.text（文字コードの推定と str への変換）を経由せずにバイト列から読む
+        return json.loads(response.content)
 
-    response = requests.post(url, headers=headers, json=data)
-    print(response.text)
-    return json.loads(response.text)
+
+class SearchResponseError(RuntimeError):
+    """検索のレスポンスが検索結果ではない（エラーのレスポンスなど）"""
+
+
+def _check_search_response(search_response: dict):
+    # 0 件のときは results が省略されるが、attributionToken は必ず付く
+    if 'error' in search_response:
+        raise SearchResponseError('search failed: {}'.format(search_response['error']))
+    if 'results' not in search_response and not (
+        search_response.get('attributionToken') or search_response.get('attribution_token')
+    ):
+        raise SearchResponseError('search response has no results')
 
 
 def parse_result_by_curl(
     search_response: dict,
-    display_count=global_search_settings['display_count'],
+    display_count=None,
 ):
+    # エラーを 0 件の結果として扱う（キャッシュする）ことのないよう例外にする
+    _check_search_response(search_response)
+    if display_count is None:
+        display_count = global_search_settings['display_count']
     response = {
         'meta': {},
         'result': []
     }
 
-    # サマリー、メタ情報
+    # サマリー、メタ情報（REST のレスポンスは camelCase）
     response['meta'] = dict(
-        total_size=search_response.get('total_size', 0),
-        attribution_token=search_response.get('attribution_token', ''),
-        next_page_token=search_response.get('next_page_token', '')
+        total_size=search_response.get(
+            'totalSize', search_response.get('total_size', 0)
+        ),
+        attribution_token=search_response.get(
+            'attributionToken', search_response.get('attribution_token', '')
+        ),
+        next_page_token=search_response.get(
+            'nextPageToken', search_response.get('next_page_token', '')
+        ),
     )
 
     # 検索結果
-    i = 0
-    for r in search_response['results']:
-        if i == display_count:
+    results = response['result']
+    black_list = _black_list
+    for r in search_response.get('results', ()):
+        if len(results) == display_count:
             break
-        source = ''
-        struct_data = r['document'].get('structData')
-        derived_struct_data = r['document']['derivedStructData']
-        title, customer, link = ('', '', '')
+        document = r['document']
+        struct_data = document.get('structData')
+        derived_struct_data = document['derivedStructData']
 
         if not struct_data:
             # ドライブのデータ
             title = "Google Drive のデータ"
-            customer = r['document']['derivedStructData']['title']
-            link = r['document']['derivedStructData']['link']
+            customer = derived_struct_data['title']
+            link = derived_struct_data['link']
             source = 'GOOGLE_DRIVE'
         else:
             # BigQuery からのデータ
             title = struct_data.get('title')
-            customer = struct_data.get('customer_company_name_in_japanese')
-            if not customer:
-                customer = struct_data.get('customer_name')
+            customer = (
+                struct_data.get('customer_company_name_in_japanese')
+                or struct_data.get('customer_name')
+            )
             gs_url = derived_struct_data.get('link')
             link = 'https://storage.cloud.google.com/{}'.format(gs_url.split('//')[1])
             source = 'CLOUD_STORAGE'
 
         # global_black_list に登録された PDF の場合は検索から除外する
-        if title in global_black_list:
+        if title in black_list:
             continue
-        
-        extractive_answers = ""
-        if derived_struct_data.get('extractive_answers'):
-            extractive_answers = derived_struct_data["extractive_answers"][0]["content"]
-
-        snippet = ""
-        snippet_status = False
-        if derived_struct_data.get('snippets'):
-            snippet = derived_struct_data["snippets"][0]["snippet"]
-            snippet_status = derived_struct_data["snippets"][0]["snippet_status"]
-
-        response['result'].append(
-            dict(
-                # タイトル
+
+        extractive_answers = derived_struct_data.get('extractive_answers')
+        snippets = derived_struct_data.get('snippets')
+        results.append(
+            SearchResult(
                 title=title,
-                # リンク先
                 link=link or 'https://www.google.com/',
-                # 顧客名
                 customer=customer,
-                # 抽出
-                extractive_segment=extractive_answers,
-                # スニペット文字列
-                snippet=snippet,
-                # スニペットを取得できたかどうか
-                snippet_status=snippet_status,
-                # source
+                extractive_segment=extractive_answers[0]['content'] if extractive_answers else '',
+                snippet=snippets[0]['snippet'] if snippets else '',
+                snippet_status=snippets[0]['snippet_status'] if snippets else False,
                 source=source,
             )
         )
-        i += 1
 
     return response
 
 
-def generate_text(prompt: str) -> str:
-    """プロンプトに与えた内容を生成 AI モデルで処理する"""
-    # Load the model
-    multimodal_model = GenerativeModel("gemini-1.5-pro-002")
-    # config
-    config = GenerationConfig(
+# 生成 AI モデルの settings
+global_generation_settings = {
+    # 起動時にモデルへ小さなリクエストを送って接続を確立しておくか
+    'warm_up_request': os.environ.get('MODEL_WARMUP_REQUEST', '0') == '1',
+    # 要約に使うモデル（GENERATION_MODELS の先頭。それ以外は遅いときや失敗したときに使う）
+    'model_name': global_generation_policy_settings['models'][0],
+    'config': dict(
         temperature=0,
         top_p=1,
         top_k=32,
         max_output_tokens=2048,
+    ),
+    # 1 にすると回答の条件（system_instruction）を Vertex AI のコンテキストキャッシュに置く
+    'context_cache': os.environ.get('PROMPT_CONTEXT_CACHE', '0') == '1',
+    # コンテキストキャッシュの有効期限（秒）
+    'context_cache_ttl': int(os.environ.get('PROMPT_CONTEXT_CACHE_TTL', 3600)),
+}
+
+
+# 締め切り・ヘッジ・サーキットブレーカー
+generation_policy = GenerationPolicy()
+
+
+def _load_model(model_name: str = None):
+    """共有の (GenerativeModel, GenerationConfig) を返す"""
+    model_name = model_name or global_generation_settings['model_name']
+    init_vertexai()
+    if global_generation_settings['context_cache']:
+        try:
+            entry = model_registry.get_cached(
+                model_name,
+                global_generation_settings['config'],
+                SYSTEM_INSTRUCTION,
+                global_generation_settings['context_cache_ttl'],
+            )
+        except Exception as e:
+            # 作り直せるまでは system_instruction をリクエストごとに送る
+            logger.error('ERROR in context cache: %s', e)
+            entry = None
+        if entry is not None:
+            return entry
+    return model_registry.get(
+        model_name,
+        global_generation_settings['config'],
+        SYSTEM_INSTRUCTION,
+    )
+
+
+def _summary_cache_key(prompt: str) -> str:
+    # 回答の条件が変わったら保存済みの要約は使わない
+    return prompt_fingerprint(
+        global_generation_settings['model_name'],
+        global_generation_settings['config'],
+        [SYSTEM_INSTRUCTION, prompt],
+    )
+
+
+def _summary_cache_get(cache, key: str):
+    """保存された要約を返す。読めない場合（database is locked など）は None"""
+    try:
+        return cache.get(key)
+    except sqlite3.Error as e:
+        # キャッシュが使えなくてもモデルで生成する
+        logger.error('ERROR in summary cache get: %s', e)
+        return None
+
+
+def _summary_cache_set(cache, key: str, model_name: str, summary: str):
+    if not summary:
+        # 空の要約を保存すると、以降の同じプロンプトは生成せずに空を返してしまう
+        return
+    try:
+        cache.set(key, model_name, summary)
+    except sqlite3.Error as e:
+        logger.error('ERROR in summary cache set: %s', e)
+
+
+def _record_usage(usage, started_at: float, stream: bool, model_name: str):
+    """生成 1 回の入力・出力のトークン数と処理時間を記録する"""
+    fields = {
+        'model': model_name,
+        'stream': stream,
+        'seconds': round(time.perf_counter() - started_at, 3),
+    }
+    if usage is not None:
+        fields.update(
+            input_tokens=getattr(usage, 'prompt_token_count', 0) or 0,
+            cached_tokens=getattr(usage, 'cached_content_token_count', 0) or 0,
+            output_tokens=getattr(usage, 'candidates_token_count', 0) or 0,
+        )
+        for kind in ['input', 'cached', 'output']:
+            metrics.inc(
+                'generate_tokens_total',
+                '生成 AI モデルのトークン数（cached は input のうちコンテキストキャッシュから読んだ分）',
+                fields[kind + '_tokens'],
+                kind=kind,
+            )
+    logger.info('USAGE generate', extra={'fields': fields})
+
+
+def generate_text(prompt: str) -> str:
+    """プロンプトに与えた内容を生成 AI モデルで処理する"""
+    # temperature=0 なので同じプロンプトには保存済みの要約を返す
+    cache = get_summary_cache()
+    key = _summary_cache_key(prompt)
+    if cache is not None:
+        cached = _summary_cache_get(cache, key)
+        _count_cache('summary', cached is not None)
+        if cached is not None:
+            return cached
+    if not global_single_flight_settings['enabled']:
+        return _generate_text(prompt, key, cache)
+    return summary_flight.do(key, lambda: _generate_text(prompt, key, cache))
+
+
+def _generate_text(prompt: str, key: str, cache) -> str:
+    def call(model_name):
+        # Load the model
+        multimodal_model, config = _load_model(model_name)
+        # Query the model
+        started_at = time.perf_counter()
+        response = multimodal_model.generate_content(
+            [
+                # Add an example query
+                prompt
+            ],
+            generation_config=config
+        )
+        _record_usage(getattr(response, 'usage_metadata', None), started_at, False, model_name)
+        # 空の応答は chunk にしない（他のモデルの結果を待つ）
+        text = response.text
+        return [text] if text else []
+
+    generation = generation_policy.stream(call)
+    with metrics.span('generate'):
+        summary = ''.join(generation)
+    log_payload(logger, 'prompt', prompt)
+    log_payload(logger, 'summary', summary, model=generation.model_name)
+    # 先頭のモデル以外で生成したものは保存しない
+    if cache is not None and generation.model_name == global_generation_settings['model_name']:
+        _summary_cache_set(cache, key, generation.model_name, summary)
+    return summary
+
+
+def generate_text_stream(prompt: str):
+    """generate_text のストリーミング版。生成されたテキストを届いた順に yield する"""
+    cache = get_summary_cache()
+    key = _summary_cache_key(prompt)
+    if cache is not None:
+        cached = _summary_cache_get(cache, key)
+        _count_cache('summary', cached is not None)
+        if cached is not None:
+            yield cached
+            return
+    if not global_single_flight_settings['enabled']:
+        yield from _generate_text_stream(prompt, key, cache)
+        return
+    # 同じプロンプトを生成中なら、届いている chunk から合流する
+    yield from summary_flight.stream(
+        key, lambda: _generate_text_stream(prompt, key, cache)
     )
-    # Query the model
-    response = multimodal_model.generate_content(
-        [
-            # Add an example query
-            prompt
-        ],
-        generation_config=config
+
+
+def _generate_text_stream(prompt: str, key: str, cache):
+    def call(model_name):
+        multimodal_model, config = _load_model(model_name)
+        started_at = time.perf_counter()
+        responses = multimodal_model.generate_content(
+            [prompt],
+            generation_config=config,
+            stream=True,
+        )
+        # トークン数は最後の chunk に入っている
+        usage = None
+        for response in responses:
+            usage = getattr(response, 'usage_metadata', None) or usage
+            try:
+                text = response.text
+            except ValueError:
+                # テキストを含まない chunk（終了理由のみなど）
+                continue
+            yield text
+        _record_usage(usage, started_at, True, model_name)
+
+    # 読み出す側の処理時間も含まれうるので、最初の chunk までの時間も別に記録する
+    started_at = time.perf_counter()
+    generation = generation_policy.stream(call)
+    try:
+        log_payload(logger, 'prompt', prompt)
+        chunks = []
+        for text in generation:
+            if not chunks:
+                metrics.observe('generate_first_token', time.perf_counter() - started_at)
+            chunks.append(text)
+            yield text
+    except Exception:
+        metrics.inc('search_stage_errors_total', stage='generate')
+        raise
+    finally:
+        metrics.observe('generate', time.perf_counter() - started_at)
+    summary = ''.join(chunks)
+    log_payload(logger, 'summary', summary, model=generation.model_name)
+    # 最後まで生成できたもの（先頭のモデル以外で生成したものは除く）だけ保存する
+    if cache is not None and generation.model_name == global_generation_settings['model_name']:
+        _summary_cache_set(cache, key, generation.model_name, summary)
+
+
+def _warm_up_model():
+    if not global_generation_settings['warm_up_request']:
+        return
+    init_vertexai()
+    model_registry.warm_up(
+        global_generation_settings['model_name'],
+        global_generation_settings['config'],
+        SYSTEM_INSTRUCTION,
     )
-    print(prompt)
-    # print(response)
-    print(response.text)
-    return response.text
-
-
-def prompt_base():
-    """利用するプロンプト"""
-    return '''ユーザーと親切なアシスタント間の対話、および関連する検索結果を踏まえて、アシスタントの最終的な回答をNotebookLM風の日本語で作成してください。
-検索結果を基に、以下の条件を満たす回答を生成してください。
-回答は以下の条件を満たす必要があります。
-1. 検索結果から関連性の高い情報を最大3件活用し、**「検索結果によると、〇〇〇について、下記企業の事例が挙げられます。」**という形で回答を始め、〇〇〇には、検索クエリを参考にした適切な単語を挿入する。
-2. 企業それぞれ必ず1文で結果を回答する。
-3. 検索結果にない新しい情報は一切導入しない。
-4. 可能な限り検索結果から直接引用し、全く同じ表現を使用する。引用部分は「」（鉤括弧）で囲み、文末に出典（検索結果の URL を含めない）を明記する。出典部は（）（丸括弧）で囲みます。
-5. 各項目は箇条書き形式で記述する。
-6. 文頭に「-」記号を付ける。
-7. Googleのウェブベースの日本語に沿った、カジュアルでわかりやすい文体を使用する。
-8. 企業名は太字で強調表示する。
-9. 専門用語については、可能な限り一般的な言葉で言い換えるか、括弧内に簡潔な説明を加える。
-10. 可能な限り、具体的な使用例や事例、数値データを含めて説明する。
-11. 検索結果に含まれる情報の日付に注意し、最新の情報を優先して使用する。古い情報を使用する場合は、その旨を明記する（例：2023年7月時点の情報では...）。
-12. 検索結果に複数の観点が含まれる場合は、それらを公平に扱い、バランスの取れた回答を心がける。
-13. 個人情報や機密情報が含まれている可能性がある場合は、それらを慎重に扱い、必要に応じて一般化または匿名化する。
-14. 出力にHTMLタグを含めない。
-15. 各文末で改行すること。
-16. 検索結果が1件以上存在する場合、要約結果から推薦される次の検索単語候補を 3 つ生成し、以下のフォーマットで追記する。
-{"recommendations": ["検索ワード1", "検索ワード2" , "検索ワード3"]}
-17. 検索結果が1件以上存在する場合、回答の最後に、「質問の意図とずれている場合は、遠慮なく別の表現で質問してくださいね。」という一文を追加する。
-18. 検索結果が0件の場合は「該当する結果を取得できませんでした、別の表現で質問してみてください」と回答する。
-19. 検索結果に含まれる法人名については正しいものを利用する。
-20. 検索結果に含まれる法人名が明確でない場合は省略を行い検索結果の概要を説明したうえで、「詳細は検索結果を確認してください」で回答を終えること。
-21. 要約結果から Google Drive のURL (https://drive. で始まるURL)、及び Google Cloud Storage のURL (https://storage.) で始まる URL を削除する。
-22. 検索結果に事例が含まれない場合はファイルのタイトル（拡張子を除外）を太字表記し、内容から短い要約を作成し、「詳細は検索結果を確認してください」で回答を終えること。
-
-なお、検索結果のタイトルとURLは、===== で囲まれたプロンプト末尾にある。
-
-=====
-
-'''[1:-1]
\ No newline at end of file
+
+
+def warm_up():
+    """起動直後に呼び出し、初回の検索で行う初期化を先に済ませておく"""
+    steps = [
+        ('history', history_snapshot.get_histories),
+        ('vertexai', _load_model),
+        ('model', _warm_up_model),
+        ('token', get_token),
+    ]
+    for name, fn in steps:
+        started_at = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logger.error('ERROR in warm up (%s): %s', name, e)
+            continue
+        logger.info('WARMUP %s', name, extra={'fields': {
+            'step': name,
+            'seconds': round(time.perf_counter() - started_at, 3),
+        }})
+
+
+# /metrics に各コンポーネントの統計値を出力する
+metrics.register_collector('token', get_token_stats)
+metrics.register_collector('transport', get_transport_stats)
+metrics.register_collector('search_cache', get_search_cache_stats)
+metrics.register_collector('query_counter', get_query_counter_stats)
+metrics.register_collector('history', history_snapshot.stats)
+metrics.register_collector('model_registry', model_registry.stats)
+metrics.register_collector('search_flight', search_flight.stats)
+metrics.register_collector('summary_flight', summary_flight.stats)
+metrics.register_collector('generation', generation_policy.stats)
+metrics.register_collector(
+    'summary_cache',
+    lambda: get_summary_cache().stats() if get_summary_cache() else {},
+)
@@ -1,36 +1,151 @@
+import datetime
 import json
 import os
+import threading
 
-import google
 import google.auth.transport.requests
-import google.oauth2.credentials
-import requests
-from google.auth import compute_engine
 from google.oauth2 import service_account
 
-token = None
-
-def _retreive_token():
-    global token
-
-    # credentials, project_id = google.auth.default()
-    credentials = service_account.Credentials.from_service_account_info(
-        json.loads(os.environ['SERVICE_ACCOUNT_INFO']),
-        scopes=[
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/cloud-platform',
-            'openid',
-            'email'
-        ],
-        subject=os.environ['SUBJECT'],
-    )
-    request = google.auth.transport.requests.Request()
-    credentials.refresh(request)
-    token = credentials.token
-
-
-def get_token():
-    global token
-    # if token is None:
-    _retreive_token()
-    return token
+from libs.log import get_logger
+
+logger = get_logger('gcp_token')
+
+# アクセストークンのキャッシュの settings
+global_token_settings = {
+    # 有効期限までの残り秒数がこれを下回ったらバックグラウンドで更新する
+    'refresh_margin_seconds': int(
+        os.environ.get('TOKEN_REFRESH_MARGIN_SECONDS', 300)
+    ),
+    # 有効期限までの残り秒数がこれを下回ったトークンは使わずに同期的に更新する
+    'expiry_skew_seconds': int(
+        os.environ.get('TOKEN_EXPIRY_SKEW_SECONDS', 30)
+    ),
+}
+
+_scopes = [
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/cloud-platform',
+    'openid',
+    'email'
+]
+
+
+class _CredentialsManager:
+    """プロセス内で 1 つの credentials を共有し、有効期限まで再利用する
+
+    - 有効期限が近づいたらバックグラウンドで更新するので、リクエストは更新を待たない
+    - 期限切れのトークンに同時にアクセスが来ても、更新は 1 回だけ実行する
+    """
+
+    def __init__(self):
+        self._credentials = None
+        self._request = None
+        # 更新処理は 1 つだけ走らせる
+        self._refresh_lock = threading.Lock()
+        # 統計値とバックグラウンド更新のフラグを守る
+        self._state_lock = threading.Lock()
+        self._background_refreshing = False
+        self._stats = {
+            'hits': 0,
+            'refreshes': 0,
+            'background_refreshes': 0,
+            'refresh_errors': 0,
+        }
+
+    def _build_credentials(self):
+        # credentials, project_id = google.auth.default()
+        return service_account.Credentials.from_service_account_info(
+            json.loads(os.environ['SERVICE_ACCOUNT_INFO']),
+            scopes=_scopes,
+            subject=os.environ['SUBJECT'],
+        )
+
+    def _seconds_left(self) -> float:
+        """トークンの有効期限までの残り秒数。トークンがなければ 0"""
+        credentials = self._credentials
+        if credentials is None or not credentials.token:
+            return 0
+        if credentials.expiry is None:
+            # 有効期限がない場合は常に有効とみなす
+            return float('inf')
+        # google-auth の expiry は naive な UTC
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (credentials.expiry - now).total_seconds()
+
+    def _count(self, key: str):
+        with self._state_lock:
+            self._stats[key] += 1
+
+    def _refresh_locked(self):
+        """_refresh_lock を取得した状態で呼び出すこと"""
+        if self._credentials is None:
+            self._credentials = self._build_credentials()
+        if self._request is None:
+            self._request = google.auth.transport.requests.Request()
+        self._credentials.refresh(self._request)
+        self._count('refreshes')
+
+    def _background_refresh(self):
+        try:
+            with self._refresh_lock:
+                # 待っている間に他のスレッドが更新していれば何もしない
+                if self._seconds_left() > global_token_settings['refresh_margin_seconds']:
+                    return
+                self._refresh_locked()
+                self._count('background_refreshes')
+        except Exception as e:
+            self._count('refresh_errors')
+            logger.error('ERROR in token refresh: %s', e)
+        finally:
+            with self._state_lock:
+                self._background_refreshing = False
+
+    def _start_background_refresh(self):
+        with self._state_lock:
+            if self._background_refreshing:
+                return
+            self._background_refreshing = True
+        threading.Thread(
+            target=self._background_refresh,
+            name='token-refresh',
+            daemon=True,
+        ).start()
+
+    def get_token(self) -> str:
+        seconds_left = self._seconds_left()
+        if seconds_left > global_token_settings['expiry_skew_seconds']:
+            # 期限が近ければ先回りして更新しておく
+            if seconds_left < global_token_settings['refresh_margin_seconds']:
+                self._start_background_refresh()
+            self._count('hits')
+            return self._credentials.token
+
+        # トークンがない / 期限切れの場合は同期的に更新する
+        with self._refresh_lock:
+            # ロック待ちの間に他のスレッドが更新していればそれを使う
+            if self._seconds_left() > global_token_settings['expiry_skew_seconds']:
+                self._count('hits')
+                return self._credentials.token
+            try:
+                self._refresh_locked()
+            except Exception:
+                self._count('refresh_errors')
+                raise
+            return self._credentials.token
+
+    def stats(self) -> dict:
+        with self._state_lock:
+            return dict(self._stats)
+
+
+_manager = _CredentialsManager()
+
+
+def get_token() -> str:
+    """有効なアクセストークンを返す"""
+    return _manager.get_token()
+
+
+def get_token_stats() -> dict:
+    """トークンキャッシュのヒット数・更新回数を返す"""
+    return _manager.stats()
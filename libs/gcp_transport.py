@@ -0,0 +1,138 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Discovery Engine への HTTP 通信の settings
+global_transport_settings = {
+    # 接続先。ローカルの偽サーバーに向けるときは環境変数で上書きする
+    'endpoint': os.environ.get(
+        'DISCOVERY_ENGINE_ENDPOINT', 'https://discoveryengine.googleapis.com'
+    ),
+    # コネクションプール
+    'pool_connections': int(os.environ.get('HTTP_POOL_CONNECTIONS', 4)),
+    'pool_maxsize': int(os.environ.get('HTTP_POOL_MAXSIZE', 32)),
+    # タイムアウト（秒）
+    'connect_timeout': float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05)),
+    'read_timeout': float(os.environ.get('HTTP_READ_TIMEOUT', 20)),
+    # リトライ
+    'max_retries': int(os.environ.get('HTTP_MAX_RETRIES', 3)),
+    'backoff_base': float(os.environ.get('HTTP_BACKOFF_BASE', 0.25)),
+    'backoff_max': float(os.environ.get('HTTP_BACKOFF_MAX', 4.0)),
+}
+
+# リトライ対象のステータスコード
+_retry_status_codes = frozenset([429, 500, 502, 503, 504])
+
+
+class Transport:
+    """keep-alive の Session を共有し、タイムアウトとリトライを付けて POST する"""
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings['pool_connections'],
+            pool_maxsize=settings['pool_maxsize'],
+            # リトライは post() 側で行う
+            max_retries=0,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'timeouts': 0,
+        }
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        """full jitter の指数バックオフ。Retry-After があればそれを優先する"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.settings['backoff_max'])
+            except ValueError:
+                pass
+        cap = min(
+            self.settings['backoff_max'],
+            self.settings['backoff_base'] * (2 ** attempt),
+        )
+        return random.uniform(0, cap)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """endpoint + path に POST する。429 / 5xx とタイムアウトはリトライする"""
+        url = self.settings['endpoint'] + path
+        kwargs.setdefault(
+            'timeout',
+            (self.settings['connect_timeout'], self.settings['read_timeout']),
+        )
+        self._count('requests')
+        max_retries = self.settings['max_retries']
+        attempt = 0
+        while True:
+            self._count('attempts')
+            try:
+                response = self.session.post(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, requests.Timeout):
+                    self._count('timeouts')
+                if attempt >= max_retries:
+                    self._count('failures')
+                    raise
+                time.sleep(self._backoff(attempt))
+            else:
+                if response.status_code not in _retry_status_codes:
+                    return response
+                if attempt >= max_retries:
+                    self._count('failures')
+                    return response
+                retry_after = response.headers.get('Retry-After')
+                # 次の試行のためにコネクションをプールへ戻す
+                response.close()
+                time.sleep(self._backoff(attempt, retry_after))
+            attempt += 1
+            self._count('retries')
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        # urllib3 のプールの状態
+        pools = self._adapter.poolmanager.pools
+        stats['pools'] = len(pools)
+        idle = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None and pool.pool is not None:
+                # 未接続のスロットは None で埋められている
+                idle += sum(1 for c in list(pool.pool.queue) if c is not None)
+        stats['idle_connections'] = idle
+        return stats
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    """プロセスで共有する Transport を返す"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = Transport(global_transport_settings)
+    return _transport
+
+
+def get_transport_stats() -> dict:
+    """リクエスト数・リトライ数とプールの状態を返す"""
+    return get_transport().stats()
@@ -0,0 +1,287 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+
+from libs.log import get_logger
+from libs.metrics import metrics
+
+logger = get_logger('generation_policy')
+
+# 要約の生成の締め切り・ヘッジ・サーキットブレーカーの settings
+global_generation_policy_settings = {
+    # 使うモデル（先頭から順に。2 つ目以降は速いモデル）
+    'models': [
+        _.strip() for _ in os.environ.get(
+            'GENERATION_MODELS', 'gemini-1.5-pro-002,gemini-1.5-flash-002'
+        ).split(',') if _.strip()
+    ],
+    # 1 回の生成の締め切り（秒）。過ぎたら GenerationTimeout
+    'deadline': float(os.environ.get('GENERATION_DEADLINE_SECONDS', 30)),
+    # 最初の chunk がこの秒数までに届かなければ次のモデルにも同時にリクエストする（0 なら失敗したときだけ）
+    'hedge_delay': float(os.environ.get('GENERATION_HEDGE_DELAY_SECONDS', 4)),
+    # 連続してこの回数失敗したモデルは reset_seconds の間使わない
+    'failure_threshold': int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 5)),
+    'reset_seconds': float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', 30)),
+}
+
+_states = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class GenerationTimeout(TimeoutError):
+    """締め切りまでに生成が終わらなかった"""
+
+
+class CircuitOpen(RuntimeError):
+    """全てのモデルのサーキットブレーカーが開いている"""
+
+
+class CircuitBreaker:
+    """連続して失敗したモデルをしばらく呼ばない
+
+    - closed: 通常どおり呼ぶ
+    - open: failure_threshold 回連続で失敗した。reset_seconds の間は呼ばない
+    - half_open: reset_seconds が過ぎた。1 回だけ試し、成功すれば closed、失敗すれば open に戻す
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        # half_open で試している呼び出しがあるか
+        self._trial = False
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == 'open':
+                if time.monotonic() - self._opened_at < self.reset_seconds:
+                    self._stats['rejected'] += 1
+                    return False
+                self._state = 'half_open'
+            if self._state == 'half_open':
+                if self._trial:
+                    self._stats['rejected'] += 1
+                    return False
+                self._trial = True
+            return True
+
+    def record(self, ok):
+        """呼び出しの結果。ok が None なら結果を待たずに打ち切った（成否に数えない）"""
+        with self._lock:
+            self._trial = False
+            if ok is None:
+                return
+            if ok:
+                self._state = 'closed'
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self._stats['opened'] += 1
+                    logger.warning('circuit opened: %s', self.name)
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, failures=self._failures, state=_states[self._state])
+
+
+class _Attempt:
+    """1 つのモデルへのリクエスト。別スレッドで chunk を読み、共有のキューに入れる
+
+    採用されなかった場合も最後まで待ち、失敗したかどうかをサーキットブレーカーに記録する
+    """
+
+    def __init__(self, model_name: str, call, results: queue.Queue, breaker: CircuitBreaker):
+        self.model_name = model_name
+        self.cancelled = threading.Event()
+        self._breaker = breaker
+        self._finished = False
+        self._lock = threading.Lock()
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run,
+            args=(self._pump, call, results),
+            name='generate-{}'.format(model_name),
+            daemon=True,
+        ).start()
+
+    def finish(self, ok):
+        """サーキットブレーカーに 1 回だけ記録する（ok が None なら成否に数えない）"""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._breaker.record(ok)
+
+    def _pump(self, call, results: queue.Queue):
+        try:
+            for chunk in call(self.model_name):
+                if self.cancelled.is_set():
+                    # 他のモデルを採用した（遅かっただけなので失敗には数えない）
+                    self.finish(None)
+                    return
+                results.put((self, 'chunk', chunk))
+            self.finish(True)
+            results.put((self, 'done', None))
+        except BaseException as e:
+            self.finish(False)
+            results.put((self, 'error', e))
+
+
+class HedgedGeneration:
+    """1 回の生成。イテレートすると、採用したモデルの chunk を届いた順に返す
+
+    - 先頭のモデルから始め、hedge_delay までに最初の chunk が届かない、または失敗したら次のモデルも呼ぶ
+    - 最初に chunk を返したモデルを採用し、他のモデルの結果は読み捨てる（chunk を返さずに終わったモデルは採用しない）
+    - 締め切りを過ぎたら GenerationTimeout、全てのモデルが失敗したら最後の例外を送る
+    """
+
+    def __init__(self, policy, call):
+        self._policy = policy
+        self._call = call
+        # 採用したモデル（最初の chunk が届いたら決まる）
+        self.model_name = None
+        # 2 つ目以降のモデルを呼んだか
+        self.hedged = False
+
+    def _outcome(self, attempt, outcome: str):
+        metrics.inc(
+            'generation_attempts_total',
+            'モデルごとの生成の結果（won / lost / error / empty / timeout / skipped）',
+            model=attempt if isinstance(attempt, str) else attempt.model_name,
+            outcome=outcome,
+        )
+
+    def __iter__(self):
+        policy = self._policy
+        settings = policy.settings
+        results = queue.Queue()
+        remaining = list(settings['models'])
+        live = []
+        error = None
+
+        def launch() -> bool:
+            # サーキットブレーカーが開いていないモデルを 1 つ呼ぶ
+            while remaining:
+                model_name = remaining.pop(0)
+                if policy.breakers[model_name].allow():
+                    live.append(_Attempt(
+                        model_name, self._call, results, policy.breakers[model_name]
+                    ))
+                    if len(live) > 1 or model_name != settings['models'][0]:
+                        self.hedged = True
+                        metrics.inc('generation_hedges_total', '2 つ目以降のモデルを呼んだ回数')
+                    return True
+                self._outcome(model_name, 'skipped')
+            return False
+
+        started_at = time.monotonic()
+        deadline_at = started_at + settings['deadline']
+        if not launch():
+            raise CircuitOpen('all models are unavailable: {}'.format(settings['models']))
+        hedge_at = started_at + settings['hedge_delay'] if settings['hedge_delay'] > 0 else None
+        winner = None
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline_at:
+                    for attempt in live:
+                        attempt.cancelled.set()
+                        attempt.finish(False)
+                        self._outcome(attempt, 'timeout')
+                    live.clear()
+                    raise GenerationTimeout(
+                        'generation did not finish in {}s'.format(settings['deadline'])
+                    )
+                wait = deadline_at - now
+                if winner is None and hedge_at is not None:
+                    if now >= hedge_at:
+                        # 遅いので次のモデルにも同時にリクエストする
+                        launch()
+                        hedge_at = now + settings['hedge_delay'] if remaining else None
+                        continue
+                    wait = min(wait, hedge_at - now)
+                try:
+                    attempt, kind, value = results.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if attempt not in live:
+                    continue
+                if kind == 'error':
+                    live.remove(attempt)
+                    self._outcome(attempt, 'error')
+                    logger.error('ERROR in generate (%s): %s', attempt.model_name, value)
+                    error = value
+                    if attempt is winner:
+                        raise value
+                    # 失敗したら待たずに次のモデルを呼ぶ
+                    if not live and not launch():
+                        raise error
+                    continue
+                if kind == 'done' and winner is None:
+                    # chunk を返さずに終わった（空の応答）。採用せず、他のモデルを待つ
+                    live.remove(attempt)
+                    self._outcome(attempt, 'empty')
+                    if not live and not launch():
+                        if error is not None:
+                            raise error
+                        return
+                    continue
+                if winner is None:
+                    winner = attempt
+                    self.model_name = attempt.model_name
+                    for other in live:
+                        if other is not attempt:
+                            other.cancelled.set()
+                            self._outcome(other, 'lost')
+                    live[:] = [attempt]
+                if kind == 'chunk':
+                    yield value
+                    continue
+                # done
+                live.remove(attempt)
+                self._outcome(attempt, 'won')
+                return
+        finally:
+            # 途中で読むのをやめた場合も、残りのリクエストは読み捨てる
+            for attempt in live:
+                attempt.cancelled.set()
+
+
+class GenerationPolicy:
+    """モデルの順序・締め切り・ヘッジ・サーキットブレーカーをまとめて持つ"""
+
+    def __init__(self, settings: dict = None):
+        self.settings = settings or global_generation_policy_settings
+        self.breakers = {
+            model_name: CircuitBreaker(
+                model_name,
+                self.settings['failure_threshold'],
+                self.settings['reset_seconds'],
+            )
+            for model_name in self.settings['models']
+        }
+
+    def stream(self, call) -> HedgedGeneration:
+        """call(model_name) は chunk（str）のイテレータを返す関数"""
+        return HedgedGeneration(self, call)
+
+    def stats(self) -> dict:
+        stats = {}
+        for model_name, breaker in self.breakers.items():
+            for key, value in breaker.stats().items():
+                stats['{}_{}'.format(model_name, key)] = value
+        return stats
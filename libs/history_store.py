@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+
+from libs.gcp_clients import firestore_module
+from libs.leaderboard import leaderboard_ref
+from libs.log import get_logger
+
+logger = get_logger('history_store')
+
+# 検索履歴のスナップショットの settings
+global_history_settings = {
+    # listener: on_snapshot で更新を受け取る / poll: 定期的に読み直す
+    'mode': os.environ.get('HISTORY_SNAPSHOT_MODE', 'listener'),
+    # poll のときの読み直しの間隔（秒）
+    'refresh_interval_seconds': float(os.environ.get('HISTORY_REFRESH_INTERVAL', 30)),
+    # 最初のスナップショットを待つ最大の秒数
+    'initial_wait_seconds': float(os.environ.get('HISTORY_INITIAL_WAIT', 10)),
+}
+
+
+class HistorySnapshot:
+    """Queries コレクションの履歴をプロセス内に保持する
+
+    Firestore の listener（または定期的な読み直し）で更新し、描画のたびに Firestore を読まない。
+    pick up / 直近のクエリのリストは更新時に作っておく。検索回数順はランキングのドキュメントを使う。
+    """
+
+    def __init__(self, get_client, collection: str = 'Queries', limit: int = 1000,
+                 mode: str = 'listener', refresh_interval_seconds: float = 30,
+                 initial_wait_seconds: float = 10):
+        # Firestore のクライアントは最初に読むときに作る
+        self.get_client = get_client
+        self.collection = collection
+        self.limit = limit
+        self.mode = mode
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.initial_wait_seconds = initial_wait_seconds
+        # 各クエリの結果（ドキュメントの dict のリスト）
+        self._results = {'picked_ups': [], 'recent': [], 'by_count': []}
+        # 読み出し用のリスト。更新時に丸ごと差し替える
+        self._state = {'picked_ups': [], 'user_queries': [], 'by_count': []}
+        self._lock = threading.Lock()
+        # 最初の結果が届いたクエリ
+        self._loaded = set()
+        self._ready = threading.Event()
+        self._started = False
+        self._watches = []
+        self._stats = {'updates': 0, 'errors': 0}
+
+    def _queries(self) -> dict:
+        firestore = firestore_module()
+
+        client = self.get_client()
+        col = client.collection(self.collection)
+        return {
+            # isPickUp: true - 優先的に取得する
+            'picked_ups': col.where(
+                filter=firestore.FieldFilter("isPickUp", "==", True)
+            ).limit(self.limit),
+            # isUserQuery: true - ユーザのクエリ（直近 N 件）
+            'recent': col.order_by(
+                "updatedAt", direction=firestore.Query.DESCENDING
+            ).limit(self.limit),
+            # 検索回数が多い順（ランキングのドキュメント 1 件）
+            'by_count': leaderboard_ref(client),
+        }
+
+    def _rebuild(self):
+        """_lock を取得した状態で呼び出すこと"""
+        picked_ups = list(self._results['picked_ups'])
+        picked_up_queries = set(_.get('query') for _ in picked_ups)
+        user_queries = []
+        seen = set()
+        for dict_ in self._results['recent']:
+            if dict_.get('isPickUp'):
+                continue
+            # 同じクエリが 2 件表示されないようにする
+            q = dict_.get('query')
+            if q in picked_up_queries or q in seen:
+                continue
+            seen.add(q)
+            user_queries.append(dict_)
+        self._state = {
+            'picked_ups': picked_ups,
+            'user_queries': user_queries,
+            'by_count': list(self._results['by_count']),
+        }
+        self._stats['updates'] += 1
+
+    def _set_result(self, name: str, docs: list):
+        if name == 'by_count':
+            # ランキングのドキュメントからエントリを取り出す
+            dicts = []
+            for doc in docs:
+                if doc.exists:
+                    dicts = doc.to_dict().get('entries', [])
+        else:
+            dicts = [_.to_dict() for _ in docs]
+        with self._lock:
+            self._results[name] = dicts
+            self._rebuild()
+            self._loaded.add(name)
+            if len(self._loaded) == len(self._results):
+                self._ready.set()
+
+    def refresh(self):
+        """Firestore から全て読み直す"""
+        firestore = firestore_module()
+
+        for name, query in self._queries().items():
+            if isinstance(query, firestore.DocumentReference):
+                self._set_result(name, [query.get()])
+            else:
+                self._set_result(name, list(query.stream()))
+
+    def _poll(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.error('ERROR in history refresh: %s', e)
+            time.sleep(self.refresh_interval_seconds)
+
+    def _listen(self):
+        for name, query in self._queries().items():
+            def on_snapshot(docs, changes, read_time, name=name):
+                self._set_result(name, docs)
+            self._watches.append(query.on_snapshot(on_snapshot))
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.mode == 'listener':
+            try:
+                self._listen()
+                return
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.error('ERROR in history listener: %s', e)
+        threading.Thread(target=self._poll, name='history-refresh', daemon=True).start()
+
+    def _get_state(self) -> dict:
+        if not self._ready.is_set():
+            self.start()
+            # 最初のスナップショットが届かなければ直接読む
+            if not self._ready.wait(self.initial_wait_seconds):
+                self.refresh()
+        return self._state
+
+    def get_histories(self, count: int = 10) -> list:
+        state = self._get_state()
+        picked_ups = state['picked_ups']
+        return picked_ups + state['user_queries'][:max(count - len(picked_ups), 0)]
+
+    def get_histories_by_count(self, count: int = 100) -> list:
+        return self._get_state()['by_count'][:count]
+
+    def stop(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,95 @@
+import os
+import time
+
+from libs.gcp_clients import firestore_module, get_firestore_client
+from libs.query_keys import query_document_id
+
+# よく検索されているワードのランキングの settings
+global_leaderboard_settings = {
+    'collection': 'Stats',
+    'document': 'leaderboard',
+    # 保持する件数
+    'size': int(os.environ.get('LEADERBOARD_SIZE', 20)),
+}
+
+
+def leaderboard_ref(client):
+    return client.collection(global_leaderboard_settings['collection']).document(
+        global_leaderboard_settings['document']
+    )
+
+
+def _entry(dict_: dict) -> dict:
+    return dict(
+        # 表記ゆれや移行前後のドキュメントを同じエントリとして扱う
+        key=query_document_id(dict_['query']),
+        query=dict_['query'],
+        count=dict_.get('count', 0),
+    )
+
+
+def _top(entries: list) -> list:
+    return sorted(entries, key=lambda _: _['count'], reverse=True)[
+        :global_leaderboard_settings['size']
+    ]
+
+
+def update_leaderboard(client, refs: list, collection: str = 'Queries'):
+    """検索回数が変わったドキュメントをランキングに反映する
+
+    トランザクション内で各ドキュメントの現在の検索回数を読むので、同時に更新されても正しい順位になる。
+    ランキングのドキュメントが無ければ、検索回数順の上位から作る。
+    """
+    firestore = firestore_module()
+
+    transaction = client.transaction()
+    board_ref = leaderboard_ref(client)
+
+    @firestore.transactional
+    def run(transaction):
+        board = board_ref.get(transaction=transaction)
+        if board.exists:
+            entries = board.to_dict().get('entries', [])
+        else:
+            query = client.collection(collection).order_by(
+                "count", direction=firestore.Query.DESCENDING
+            ).limit(global_leaderboard_settings['size'])
+            entries = [_entry(_.to_dict()) for _ in transaction.get(query)]
+        merged = {_['key']: _ for _ in entries}
+        for snapshot in client.get_all(refs, transaction=transaction):
+            if snapshot.exists and snapshot.get('query'):
+                entry = _entry(snapshot.to_dict())
+                merged[entry['key']] = entry
+        transaction.set(
+            board_ref,
+            dict(
+                entries=_top(merged.values()),
+                updatedAt=int(time.time()),
+            )
+        )
+
+    run(transaction)
+
+
+def rebuild_leaderboard(client, collection: str = 'Queries'):
+    """検索回数順の上位からランキングを作り直す"""
+    firestore = firestore_module()
+
+    query = client.collection(collection).order_by(
+        "count", direction=firestore.Query.DESCENDING
+    ).limit(global_leaderboard_settings['size'])
+    entries = {}
+    for snapshot in query.stream():
+        entry = _entry(snapshot.to_dict())
+        entries.setdefault(entry['key'], entry)
+    leaderboard_ref(client).set(
+        dict(
+            entries=_top(entries.values()),
+            updatedAt=int(time.time()),
+        )
+    )
+
+
+if __name__ == '__main__':
+    # python -m libs.leaderboard でランキングを作り直す
+    rebuild_leaderboard(get_firestore_client())
@@ -0,0 +1,173 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+# ログの settings
+global_log_settings = {
+    'level': os.environ.get('LOG_LEVEL', 'INFO'),
+    # 検索結果やプロンプトなどの全文を出力するリクエストの割合（0 - 1）
+    'payload_sample_rate': float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', 0.01)),
+    # 全文を出力しないときに残す文字数
+    'payload_max_chars': int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', 256)),
+}
+
+
+class RequestContext:
+    """1 回の検索に付ける ID と、全文のログを出力するかどうか"""
+
+    __slots__ = ('request_id', 'sampled')
+
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.sampled = sampled
+
+
+_request_context = contextvars.ContextVar('request_context', default=None)
+
+
+def start_request() -> RequestContext:
+    """新しいリクエスト ID を発行し、このスレッド（コンテキスト）のログに付ける"""
+    context = RequestContext(
+        request_id=uuid.uuid4().hex[:16],
+        sampled=random.random() < global_log_settings['payload_sample_rate'],
+    )
+    _request_context.set(context)
+    return context
+
+
+def use_request(context: RequestContext):
+    """別スレッドで同じリクエストのログを出力するときに呼び出す"""
+    _request_context.set(context)
+
+
+def truncate(text: str, limit: int = None) -> str:
+    if limit is None:
+        limit = global_log_settings['payload_max_chars']
+    if text is None or len(text) <= limit:
+        return text
+    return '{}...(+{} chars)'.format(text[:limit], len(text) - limit)
+
+
+class _ContextFilter(logging.Filter):
+    """呼び出したスレッドのリクエスト ID をレコードに付ける（キューに入れる前に実行される）"""
+
+    def filter(self, record):
+        context = _request_context.get()
+        record.request_id = context.request_id if context else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Cloud Logging が解釈できる 1 行の JSON"""
+
+    def format(self, record):
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+            + '.{:03d}Z'.format(int(record.msecs)),
+            'logger': record.name,
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 整形は出力スレッドで行うので、ここではメッセージの展開と例外の文字列化だけ行う
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """書き込むたびに sys.stdout を参照する（差し替えられた stdout にも出力する）"""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _configure():
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        # 出力（JSON への変換と stdout への書き込み）は別スレッドで行う
+        log_queue = queue.SimpleQueue()
+        handler = _QueueHandler(log_queue)
+        handler.addFilter(_ContextFilter())
+        stream_handler = _StdoutHandler()
+        stream_handler.setFormatter(JsonFormatter())
+        listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        listener.start()
+        # 終了時に残っているログを出力する
+        atexit.register(listener.stop)
+
+        root = logging.getLogger('app')
+        root.setLevel(global_log_settings['level'])
+        root.addHandler(handler)
+        root.propagate = False
+        _configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    _configure()
+    return logging.getLogger('app.' + name)
+
+
+def log_payload(logger: logging.Logger, message: str, payload, **fields):
+    """検索結果やプロンプトなどの大きな文字列（str / UTF-8 の bytes）を出力する
+
+    サンプリングされたリクエストでは全文、それ以外は先頭だけを出力する
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    context = _request_context.get()
+    sampled = context.sampled if context else False
+    size_key = 'payload_bytes' if isinstance(payload, bytes) else 'payload_chars'
+    size = len(payload) if payload is not None else 0
+    truncated = False
+    if isinstance(payload, bytes):
+        # 全文を出力しないときは先頭だけを文字列にする
+        limit = global_log_settings['payload_max_chars']
+        head = payload if sampled else payload[:limit * 4]
+        truncated = len(head) < size
+        payload = head.decode('utf-8', errors='ignore')
+    if not sampled:
+        logged = truncate(payload)
+        # 実際に短くした場合だけ truncated とする
+        truncated = truncated or logged is not payload
+        payload = logged
+    fields['payload'] = payload
+    fields[size_key] = size
+    fields['payload_truncated'] = truncated
+    logger.info(message, extra={'fields': fields})
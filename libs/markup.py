@@ -0,0 +1,167 @@
+import html
+import json
+import re
+
+from libs.log import get_logger
+
+logger = get_logger('markup')
+
+# スニペットと要約のマークアップを (テキスト, 太字かどうか) の span のリストに変換する
+#
+# - スニペット: Vertex AI Search の <b>...</b> と HTML エンティティ
+# - 要約: Gemini が出力する **太字**、行頭の "- "、{"recommendations": [...]} の行
+#
+# 改行は NEWLINE で表す。テキストが空の span は作らない
+
+NEWLINE = ('\n', False)
+
+# <b> / </b>（</b> の / は複数でもよい）
+_re_snippet_bold = re.compile(r'<\/*b>')
+
+# 要約の 1 行に 1 回だけ適用する
+#   。と - の間の空白、または <br> / (,,,) だけ -> 改行（- から新しい行にする）
+#   <br>、(,,,) -> 削除
+# 以前の実装は <br> / (,,,) を削除してから 。- を改行にしていたので、。<br>- も改行にする
+# （空白と <br> / (,,,) が混ざっている場合は以前の実装でも改行にならない）
+_re_summary_cleanup = re.compile(r'。(?:\s+|(?:<br>|\(,+\))*)(?=-)|<br>|\(,+\)')
+
+_recommendations_prefix = '{"recommendations":'
+
+
+def _summary_cleanup(match) -> str:
+    return '。\n' if match.group().startswith('。') else ''
+
+
+def _split_bold(text: str, spans: list):
+    # ** で区切った奇数番目を太字にする
+    bold = False
+    for part in text.split('**'):
+        if part:
+            spans.append((part, bold))
+        bold = not bold
+
+
+def tokenize_snippet(snippet_text: str) -> list:
+    """スニペットの <b> を太字の span にする。&nbsp; などのエンティティは文字に戻す（\\xa0 は削除）"""
+    text = html.unescape(snippet_text).replace('\xa0', '')
+    spans = []
+    bold = False
+    for part in _re_snippet_bold.split(text):
+        if part:
+            spans.append((part, bold))
+        bold = not bold
+    return spans
+
+
+def parse_recommendations(line: str) -> list:
+    """{"recommendations": [...]} の行からおすすめワードを取り出す"""
+    try:
+        return json.loads(line).get('recommendations') or []
+    except (ValueError, AttributeError) as e:
+        logger.error('ERROR in recommendations: %s', e)
+        return []
+
+
+def _summary_lines(text: str, spans: list):
+    """マークアップを整理したテキストを行ごとに span にする。おすすめワードの行があれば返す"""
+    recommendations = None
+    for s in _re_summary_cleanup.sub(_summary_cleanup, text).split('\n'):
+        # おすすめワードの行は表示しない
+        if s.startswith(_recommendations_prefix):
+            if recommendations is None:
+                recommendations = parse_recommendations(s)
+            spans.append(NEWLINE)
+            continue
+        # 何も無い行は除外する
+        if s == '':
+            continue
+        text = s.strip()
+        if s.startswith('- '):
+            text = '・' + text[2:]
+        _split_bold(text, spans)
+        spans.append(NEWLINE)
+    return recommendations
+
+
+class SummaryTokenizer:
+    """要約のマークアップを逐次解釈する
+
+    生成途中のテキストを feed() で受け取り、改行まで届いた行だけを解釈する。
+    解釈済みの行は再解釈しないので、ストリーミング中に何度呼んでも先頭から読み直さない。
+    """
+
+    def __init__(self):
+        # 改行がまだ来ていない行
+        self._pending = ''
+        # 直前の空でない行が 。で終わっているか（行をまたいだ 。と - の処理に使う）
+        self._after_maru = False
+        # 。で終わる行のあとの空白だけの行の数（次が - の行なら表示しない）
+        self._held = 0
+        # 解釈済みの span
+        self.spans = []
+        # {"recommendations": ...} の行が届いたら設定される
+        self.recommendations = None
+
+    def _line(self, raw: str, spans: list):
+        stripped = raw.strip()
+        if self._after_maru and not stripped:
+            # 次の行を見るまで決められない
+            if raw:
+                self._held += 1
+            return
+        if self._held:
+            if not stripped.startswith('-'):
+                spans.extend([NEWLINE] * self._held)
+            self._held = 0
+        # 。と - の間の空白・改行は 1 つの改行にまとめる
+        if self._after_maru and stripped.startswith('-'):
+            raw = raw.lstrip()
+        if stripped:
+            self._after_maru = stripped.endswith('。')
+        recommendations = _summary_lines(raw, spans)
+        if self.recommendations is None:
+            self.recommendations = recommendations
+
+    def feed(self, chunk: str) -> list:
+        """テキストを追加し、新たに確定した span を返す"""
+        self._pending += chunk
+        if '\n' not in self._pending:
+            return []
+        *lines, self._pending = self._pending.split('\n')
+        new_spans = []
+        for line in lines:
+            self._line(line, new_spans)
+        self.spans.extend(new_spans)
+        return new_spans
+
+    def partial(self) -> list:
+        """改行がまだ来ていない行の暫定の span。確定はしない"""
+        pending = self._pending
+        # おすすめワードの JSON は途中経過を表示しない
+        if not pending.strip() or pending.lstrip().startswith('{'):
+            return []
+        state = (self._after_maru, self._held, self.recommendations)
+        spans = []
+        self._line(pending, spans)
+        self._after_maru, self._held, self.recommendations = state
+        # 行末の改行は確定時に付ける
+        return [_ for _ in spans if _ is not NEWLINE]
+
+    def close(self) -> list:
+        """残りの行を確定し、末尾の改行を削除した全 span を返す"""
+        if self._pending:
+            self._line(self._pending, self.spans)
+            self._pending = ''
+        self._held = 0
+        while self.spans and self.spans[-1] is NEWLINE:
+            self.spans.pop()
+        return self.spans
+
+
+def tokenize_summary(summary_text: str) -> list:
+    """要約全体を span のリストにする（まとめて届いている場合は行ごとの状態を持たずに 1 回で処理する）"""
+    spans = []
+    _summary_lines(summary_text, spans)
+    while spans and spans[-1] is NEWLINE:
+        spans.pop()
+    return spans
@@ -0,0 +1,186 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from libs.log import get_logger
+
+# OpenTelemetry は任意。インストールされていて有効化されていればトレースも出力する
+try:
+    from opentelemetry import trace as _otel_trace
+except ImportError:
+    _otel_trace = None
+
+logger = get_logger('metrics')
+
+# メトリクスの settings
+global_metrics_settings = {
+    # /metrics を返すポート。0 なら起動しない
+    'port': int(os.environ.get('METRICS_PORT', 0)),
+    # OpenTelemetry のトレースを出力するか（エクスポーターは OTEL_* の環境変数で設定する）
+    'otel_enabled': os.environ.get('OTEL_TRACES_ENABLED', '0') == '1',
+}
+
+# 段階ごとの処理時間のヒストグラムのバケット（秒）
+_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_tracer = None
+if _otel_trace is not None and global_metrics_settings['otel_enabled']:
+    _tracer = _otel_trace.get_tracer('vertex-ai-search-demo')
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(_buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(_buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    ) + '}'
+
+
+class MetricsRegistry:
+    """段階ごとの処理時間・エラー数・キャッシュのヒット数などを集計し、Prometheus の形式で出力する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stage -> _Histogram
+        self._histograms = {}
+        # (name, labels) -> 値
+        self._counters = {}
+        self._help = {}
+        # component -> 統計値の dict を返す関数
+        self._collectors = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = _Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, help_: str = '', value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help_:
+                self._help.setdefault(name, help_)
+
+    def register_collector(self, component: str, fn):
+        """/metrics を返すときに呼び出し、返された dict の数値を gauge として出力する"""
+        with self._lock:
+            self._collectors[component] = fn
+
+    @contextmanager
+    def span(self, stage: str):
+        """with の中の処理時間を stage の処理時間として記録する。例外はエラーとして数える"""
+        started_at = time.perf_counter()
+        otel_span = None
+        if _tracer is not None:
+            otel_span = _tracer.start_as_current_span(stage)
+            otel_span.__enter__()
+        try:
+            yield
+        except Exception as e:
+            # GeneratorExit（ストリームを途中で読むのをやめた場合）はエラーとして数えない
+            self.inc(
+                'search_stage_errors_total',
+                '段階ごとのエラー数',
+                stage=stage,
+            )
+            if otel_span is not None:
+                otel_span.__exit__(type(e), e, e.__traceback__)
+                otel_span = None
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started_at)
+            if otel_span is not None:
+                otel_span.__exit__(None, None, None)
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式"""
+        lines = []
+        with self._lock:
+            histograms = {
+                k: (list(v.counts), v.sum, v.count)
+                for k, v in self._histograms.items()
+            }
+            counters = dict(self._counters)
+            help_ = dict(self._help)
+            collectors = dict(self._collectors)
+
+        lines.append('# HELP search_stage_seconds 段階ごとの処理時間（秒）')
+        lines.append('# TYPE search_stage_seconds histogram')
+        for stage, (counts, sum_, count) in sorted(histograms.items()):
+            cumulative = 0
+            for le, n in zip(_buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('search_stage_seconds_bucket{} {}'.format(
+                    _labels(dict(stage=stage, le=le)), cumulative
+                ))
+            lines.append('search_stage_seconds_sum{} {}'.format(_labels(dict(stage=stage)), sum_))
+            lines.append('search_stage_seconds_count{} {}'.format(_labels(dict(stage=stage)), count))
+
+        names = sorted(set(name for name, _ in counters))
+        for name in names:
+            if name in help_:
+                lines.append('# HELP {} {}'.format(name, help_[name]))
+            lines.append('# TYPE {} counter'.format(name))
+            for (name_, labels), value in sorted(counters.items()):
+                if name_ == name:
+                    lines.append('{}{} {}'.format(name, _labels(dict(labels)), value))
+
+        lines.append('# HELP app_component_stat 各コンポーネントの統計値')
+        lines.append('# TYPE app_component_stat gauge')
+        for component, fn in sorted(collectors.items()):
+            try:
+                stats = fn()
+            except Exception as e:
+                logger.error('ERROR in metrics collector (%s): %s', component, e)
+                continue
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('app_component_stat{} {}'.format(
+                        _labels(dict(component=component, name=key)), value
+                    ))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def start_metrics_server(port: int):
+    """/metrics を返す HTTP サーバーを別スレッドで起動する"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    return httpd
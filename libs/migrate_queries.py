@@ -0,0 +1,91 @@
+"""Queries コレクションのドキュメント ID を、クエリから決まる ID に移行する
+
+    python -m libs.migrate_queries [--dry-run]
+
+- ランダムな ID のドキュメントを query_document_id() の ID に書き換える
+- 正規化すると同じになるクエリが複数ある場合は 1 つにまとめる
+- 移行中もアプリからの書き込みを止める必要はない（トランザクションで移行する）
+"""
+import argparse
+import os
+from base64 import b64encode
+
+from google.cloud import firestore
+
+from libs.leaderboard import rebuild_leaderboard
+from libs.query_keys import query_document_id
+
+
+def merge_entries(entries: list) -> dict:
+    """同じクエリの複数のエントリを 1 つにまとめる"""
+    # 最も検索されている表記を残す
+    base = max(entries, key=lambda _: _.get('count', 0))
+    merged = dict(base)
+    # count は「2 回目以降の検索回数」なので、検索回数の合計 - 1 にする
+    merged['count'] = sum(_.get('count', 0) + 1 for _ in entries) - 1
+    merged['createdAt'] = min(_.get('createdAt', 0) for _ in entries)
+    merged['updatedAt'] = max(_.get('updatedAt', 0) for _ in entries)
+    if any(_.get('isPickUp') for _ in entries):
+        merged['isPickUp'] = True
+    if any(_.get('isUserQuery') for _ in entries):
+        merged['isUserQuery'] = True
+    merged['base64dQuery'] = b64encode(merged['query'].encode()).decode()
+    return merged
+
+
+def _migrate_group(client, col, doc_id: str, legacy_ids: list):
+    transaction = client.transaction()
+
+    @firestore.transactional
+    def run(transaction):
+        target = col.document(doc_id)
+        refs = [target] + [col.document(_) for _ in legacy_ids]
+        snapshots = [_ for _ in client.get_all(refs, transaction=transaction) if _.exists]
+        legacy = [_ for _ in snapshots if _.id != doc_id]
+        if not legacy:
+            # 他のプロセスが移行済み
+            return
+        merged = merge_entries([_.to_dict() for _ in snapshots])
+        transaction.set(target, merged)
+        for snapshot in legacy:
+            transaction.delete(snapshot.reference)
+
+    run(transaction)
+
+
+def migrate(client, collection: str = 'Queries', dry_run: bool = False) -> dict:
+    col = client.collection(collection)
+    # doc_id -> 移行が必要なドキュメントの ID のリスト
+    groups = {}
+    total = 0
+    for entry in col.stream():
+        total += 1
+        query = entry.to_dict().get('query')
+        if not query:
+            continue
+        doc_id = query_document_id(query)
+        if entry.id != doc_id:
+            groups.setdefault(doc_id, []).append(entry.id)
+
+    for doc_id, legacy_ids in groups.items():
+        print('{} <- {}'.format(doc_id, ', '.join(legacy_ids)))
+        if not dry_run:
+            _migrate_group(client, col, doc_id, legacy_ids)
+    # 移行前の ID のエントリが残らないようにランキングを作り直す
+    if not dry_run:
+        rebuild_leaderboard(client, collection=collection)
+
+    return dict(
+        documents=total,
+        migrated_queries=len(groups),
+        migrated_documents=sum(len(_) for _ in groups.values()),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dry-run', action='store_true', help='書き込まずに対象だけ表示する')
+    parser.add_argument('--collection', default='Queries')
+    args = parser.parse_args()
+    client = firestore.Client(project=os.environ['FIRESTORE_PROJECT_ID'])
+    print(migrate(client, collection=args.collection, dry_run=args.dry_run))
@@ -0,0 +1,113 @@
+import datetime
+import json
+import threading
+import time
+
+
+class ModelRegistry:
+    """GenerativeModel と GenerationConfig をモデル名・設定ごとに 1 つだけ作って共有する
+
+    GenerativeModel の呼び出しはスレッドセーフなので、複数のセッションから同じインスタンスを使う
+    """
+
+    def __init__(self):
+        self._models = {}
+        # コンテキストキャッシュを使うモデル（キー -> (entry, 作り直す時刻)）
+        self._cached = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0, 'builds': 0, 'warm_ups': 0,
+            'context_caches': 0, 'context_cache_errors': 0,
+        }
+
+    @staticmethod
+    def _key(model_name: str, config: dict, system_instruction=None) -> tuple:
+        return (
+            model_name,
+            json.dumps(config, sort_keys=True),
+            json.dumps(system_instruction, ensure_ascii=False),
+        )
+
+    def get(self, model_name: str, config: dict, system_instruction=None) -> tuple:
+        """(GenerativeModel, GenerationConfig) を返す"""
+        key = self._key(model_name, config, system_instruction)
+        entry = self._models.get(key)
+        if entry is not None:
+            with self._lock:
+                self._stats['hits'] += 1
+            return entry
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                from vertexai.generative_models import (GenerationConfig,
+                                                        GenerativeModel)
+                kwargs = {}
+                if system_instruction is not None:
+                    kwargs['system_instruction'] = system_instruction
+                entry = (
+                    GenerativeModel(model_name, **kwargs),
+                    GenerationConfig(**config),
+                )
+                self._models[key] = entry
+                self._stats['builds'] += 1
+            else:
+                self._stats['hits'] += 1
+        return entry
+
+    def get_cached(self, model_name: str, config: dict, system_instruction: str,
+                   ttl_seconds: int, retry_seconds: int = 300):
+        """system_instruction を Vertex AI のコンテキストキャッシュ（CachedContent）に置いたモデル
+
+        有効期限の 1 割前に作り直す。作れなかった場合は例外を送り、retry_seconds の間は None を返す
+        （system_instruction が最小のトークン数に満たない場合なども作れない）
+        """
+        key = self._key(model_name, config, system_instruction)
+        now = time.monotonic()
+        cached = self._cached.get(key)
+        if cached is not None and now < cached[1]:
+            return cached[0]
+        with self._lock:
+            cached = self._cached.get(key)
+            if cached is not None and now < cached[1]:
+                return cached[0]
+            from vertexai.generative_models import GenerationConfig
+            from vertexai.preview import caching
+            from vertexai.preview.generative_models import GenerativeModel
+            try:
+                cached_content = caching.CachedContent.create(
+                    model_name=model_name,
+                    system_instruction=system_instruction,
+                    ttl=datetime.timedelta(seconds=ttl_seconds),
+                )
+            except Exception:
+                self._cached[key] = (None, now + retry_seconds)
+                self._stats['context_cache_errors'] += 1
+                raise
+            entry = (
+                GenerativeModel.from_cached_content(cached_content),
+                GenerationConfig(**config),
+            )
+            self._cached[key] = (entry, now + ttl_seconds * 0.9)
+            self._stats['context_caches'] += 1
+        return entry
+
+    def warm_up(self, model_name: str, config: dict, system_instruction=None):
+        """小さなリクエストを送り、接続を確立しておく"""
+        from vertexai.generative_models import GenerationConfig
+
+        model, _ = self.get(model_name, config, system_instruction)
+        model.generate_content(
+            ['ping'],
+            generation_config=GenerationConfig(max_output_tokens=1),
+        )
+        with self._lock:
+            self._stats['warm_ups'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['models'] = len(self._models)
+        return stats
+
+
+model_registry = ModelRegistry()
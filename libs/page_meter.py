@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from libs.metrics import metrics
+
+# 画面更新の計測の settings
+global_page_meter_settings = {
+    # 1 にすると page.update() ごとに送信するメッセージのバイト数を数える（調査用。既定は無効）
+    # JSON への変換が 1 回増え、flet の内部（CommandEncoder と send_commands）に依存するため
+    'enabled': os.environ.get('PAGE_UPDATE_METER', '0') == '1',
+}
+
+
+class PageMeter:
+    """1 セッションの画面更新の回数・送信量（バイト）・時間（秒）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.updates = 0
+            self.bytes = 0
+            self.seconds = 0.0
+
+    def add_bytes(self, size: int):
+        with self._lock:
+            self.bytes += size
+
+    @contextmanager
+    def measure(self):
+        """page.update() 1 回分を計測する"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started_at
+            with self._lock:
+                self.updates += 1
+                self.seconds += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'updates': self.updates,
+                'bytes': self.bytes,
+                'seconds': round(self.seconds, 4),
+            }
+
+
+# session_id -> PageMeter（セッションが終われば消える）
+_meters = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def _install(connection):
+    """接続の send_commands を、送信するコマンドのサイズを数えるものに置き換える（接続ごとに 1 回）"""
+    # flet は main.py から import 済み
+    from flet_core.protocol import CommandEncoder
+
+    send_commands = connection.send_commands
+
+    def measured_send_commands(session_id, commands):
+        meter = _meters.get(session_id)
+        if meter is not None:
+            size = len(json.dumps(
+                commands, cls=CommandEncoder, separators=(',', ':')
+            ).encode())
+            meter.add_bytes(size)
+            metrics.inc(
+                'page_update_bytes_total',
+                '画面更新で送信したコマンドのバイト数',
+                size,
+            )
+        return send_commands(session_id, commands)
+
+    connection.send_commands = measured_send_commands
+    connection._page_meter_installed = True
+
+
+def attach(page) -> PageMeter:
+    """page の画面更新を計測する PageMeter を返す。無効の場合は送信量を数えない"""
+    meter = PageMeter()
+    if not global_page_meter_settings['enabled'] or page.connection is None:
+        return meter
+    _meters[page.session_id] = meter
+    with _lock:
+        if not getattr(page.connection, '_page_meter_installed', False):
+            _install(page.connection)
+    return meter
@@ -0,0 +1,109 @@
+import html
+import math
+import os
+import re
+
+# プロンプトの settings
+global_prompt_settings = {
+    # プロンプトに含める上位の検索結果の件数
+    'result_count': int(os.environ.get('PROMPT_RESULT_COUNT', 3)),
+    # 検索ごとの入力（検索クエリと検索結果）のトークン数の上限（目安）
+    'token_budget': int(os.environ.get('PROMPT_TOKEN_BUDGET', 1024)),
+    # 1 にするとタイトルと URL に加えてスニペットの抜粋も token_budget の範囲で含める
+    # （入力のトークン数が増えて遅くなるので、既定ではタイトルと URL のみ）
+    'snippet_excerpts': os.environ.get('PROMPT_SNIPPET_EXCERPTS', '0') == '1',
+}
+
+# 回答の条件。どの検索でも同じなので system_instruction として送る
+SYSTEM_INSTRUCTION = '''ユーザーと親切なアシスタント間の対話、および関連する検索結果を踏まえて、アシスタントの最終的な回答をNotebookLM風の日本語で作成してください。
+検索結果を基に、以下の条件を満たす回答を生成してください。
+回答は以下の条件を満たす必要があります。
+1. 検索結果から関連性の高い情報を最大3件活用し、**「検索結果によると、〇〇〇について、下記企業の事例が挙げられます。」**という形で回答を始め、〇〇〇には、検索クエリを参考にした適切な単語を挿入する。
+2. 企業それぞれ必ず1文で結果を回答する。
+3. 検索結果にない新しい情報は一切導入しない。
+4. 可能な限り検索結果から直接引用し、全く同じ表現を使用する。引用部分は「」（鉤括弧）で囲み、文末に出典（検索結果の URL を含めない）を明記する。出典部は（）（丸括弧）で囲みます。
+5. 各項目は箇条書き形式で記述する。
+6. 文頭に「-」記号を付ける。
+7. Googleのウェブベースの日本語に沿った、カジュアルでわかりやすい文体を使用する。
+8. 企業名は太字で強調表示する。
+9. 専門用語については、可能な限り一般的な言葉で言い換えるか、括弧内に簡潔な説明を加える。
+10. 可能な限り、具体的な使用例や事例、数値データを含めて説明する。
+11. 検索結果に含まれる情報の日付に注意し、最新の情報を優先して使用する。古い情報を使用する場合は、その旨を明記する（例：2023年7月時点の情報では...）。
+12. 検索結果に複数の観点が含まれる場合は、それらを公平に扱い、バランスの取れた回答を心がける。
+13. 個人情報や機密情報が含まれている可能性がある場合は、それらを慎重に扱い、必要に応じて一般化または匿名化する。
+14. 出力にHTMLタグを含めない。
+15. 各文末で改行すること。
+16. 検索結果が1件以上存在する場合、要約結果から推薦される次の検索単語候補を 3 つ生成し、以下のフォーマットで追記する。
+{"recommendations": ["検索ワード1", "検索ワード2" , "検索ワード3"]}
+17. 検索結果が1件以上存在する場合、回答の最後に、「質問の意図とずれている場合は、遠慮なく別の表現で質問してくださいね。」という一文を追加する。
+18. 検索結果が0件の場合は「該当する結果を取得できませんでした、別の表現で質問してみてください」と回答する。
+19. 検索結果に含まれる法人名については正しいものを利用する。
+20. 検索結果に含まれる法人名が明確でない場合は省略を行い検索結果の概要を説明したうえで、「詳細は検索結果を確認してください」で回答を終えること。
+21. 要約結果から Google Drive のURL (https://drive. で始まるURL)、及び Google Cloud Storage のURL (https://storage.) で始まる URL を削除する。
+22. 検索結果に事例が含まれない場合はファイルのタイトル（拡張子を除外）を太字表記し、内容から短い要約を作成し、「詳細は検索結果を確認してください」で回答を終えること。
+
+なお、検索クエリは入力の先頭に、検索結果は ===== で囲まれた部分にある。'''
+
+_re_tags = re.compile(r'<[^>]+>')
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の目安（ASCII は 4 文字で 1 トークン、それ以外は 1 文字で 1 トークン）"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4) + len(text) - ascii_chars
+
+
+def plain_snippet(entry) -> str:
+    """スニペットのタグとエンティティを除いた本文（取得できなかった場合は空）"""
+    if entry['snippet_status'] != 'SUCCESS':
+        return ''
+    text = html.unescape(_re_tags.sub('', entry['snippet'] or ''))
+    return ' '.join(text.replace('\xa0', ' ').split())
+
+
+def _truncate(text: str, budget: int) -> str:
+    """budget（トークン）に収まるように末尾を削る"""
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) + 1 <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + '…' if low else ''
+
+
+def build_prompt(pd_result: dict, search_query: str = '',
+                 count: int = None, token_budget: int = None,
+                 snippet_excerpts: bool = None) -> str:
+    """検索ごとの入力（検索クエリと上位の検索結果）。回答の条件は SYSTEM_INSTRUCTION で別に送る
+
+    タイトルと URL を優先し、snippet_excerpts なら残りのトークン数に収まる分だけ抜粋を上位の結果から加える
+    """
+    count = count or global_prompt_settings['result_count']
+    budget = token_budget or global_prompt_settings['token_budget']
+    if snippet_excerpts is None:
+        snippet_excerpts = global_prompt_settings['snippet_excerpts']
+    head = '検索クエリ: {}\n\n=====\n'.format(search_query)
+    tail = '\n====='
+    entries = []
+    used = estimate_tokens(head) + estimate_tokens(tail)
+    for i, entry in enumerate(pd_result['result'][:count]):
+        line = '{}. {}, {}\n'.format(
+            i + 1,
+            entry['customer'] if entry['source'] == 'GOOGLE_DRIVE' else entry['title'],
+            entry['link'],
+        )
+        tokens = estimate_tokens(line)
+        # 1 件目は上限を超えても含める
+        if entries and used + tokens > budget:
+            break
+        used += tokens
+        entries.append([line, plain_snippet(entry) if snippet_excerpts else ''])
+    for item in entries:
+        excerpt = _truncate(item[1], budget - used - 1)
+        used += estimate_tokens(excerpt) + 1
+        item[1] = excerpt + '\n' if excerpt else ''
+    return head + '\n'.join(line + excerpt for line, excerpt in entries) + tail
@@ -0,0 +1,228 @@
+import atexit
+import os
+import threading
+import time
+from base64 import b64encode
+
+from libs.gcp_clients import firestore_module
+from libs.leaderboard import update_leaderboard
+from libs.log import get_logger
+from libs.query_keys import query_document_id
+
+logger = get_logger('query_counter')
+
+# 検索回数の書き込みの settings
+global_query_counter_settings = {
+    # この秒数ごとにまとめて書き込む
+    'flush_interval_seconds': float(os.environ.get('QUERY_COUNTER_FLUSH_INTERVAL', 5)),
+    # 溜まったクエリの種類がこの数に達したら待たずに書き込む
+    'max_pending_queries': int(os.environ.get('QUERY_COUNTER_MAX_PENDING', 100)),
+}
+
+# Firestore の 1 バッチの書き込み上限
+_max_batch_writes = 500
+# where(in) に渡せる値の上限
+_max_in_values = 30
+
+
+class QueryCounter:
+    """検索回数をメモリ上で集計し、バックグラウンドでまとめて Firestore に書き込む
+
+    カウントは firestore.Increment で加算し、新しいクエリは create で登録するので、
+    複数プロセスから同時に書き込んでも失われない
+    """
+
+    def __init__(self, get_client, collection: str = 'Queries',
+                 flush_interval_seconds: float = 5,
+                 max_pending_queries: int = 100):
+        # Firestore のクライアントは初回の書き込み時に作る
+        self.get_client = get_client
+        self.collection = collection
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_queries = max_pending_queries
+        # query -> 未書き込みの検索回数
+        self._pending = {}
+        self._lock = threading.Lock()
+        # 書き込みは同時に 1 つだけ
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            'added': 0,
+            'flushes': 0,
+            'written_queries': 0,
+            'flush_errors': 0,
+            'leaderboard_errors': 0,
+        }
+
+    def add(self, search_query: str):
+        """検索回数を 1 加算する（書き込みは後で行う）"""
+        with self._lock:
+            self._pending[search_query] = self._pending.get(search_query, 0) + 1
+            self._stats['added'] += 1
+            full = len(self._pending) >= self.max_pending_queries
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='query-counter-flush',
+                    daemon=True,
+                )
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """溜まっている検索回数を書き込む。失敗した分は次回に持ち越す"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            # 書き込めた分は _write が削除する（失敗したら残りだけを持ち越す）
+            remaining = dict(pending)
+            try:
+                self._write(remaining)
+            except Exception as e:
+                logger.error('ERROR in query counter flush: %s', e)
+                with self._lock:
+                    self._stats['flush_errors'] += 1
+                    self._stats['written_queries'] += len(pending) - len(remaining)
+                    for q, n in remaining.items():
+                        self._pending[q] = self._pending.get(q, 0) + n
+                return
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['written_queries'] += len(pending)
+
+    def _find_legacy_entries(self, col, search_queries: list) -> dict:
+        """ランダムな ID で登録された（移行前の）エントリを base64dQuery でまとめて引く"""
+        firestore = firestore_module()
+
+        b64_queries = {
+            b64encode(q.encode()).decode(): q for q in search_queries
+        }
+        existing = {}
+        keys = list(b64_queries)
+        for i in range(0, len(keys), _max_in_values):
+            query = col.where(
+                filter=firestore.FieldFilter(
+                    "base64dQuery", "in", keys[i:i + _max_in_values]
+                )
+            )
+            for entry in query.stream():
+                b64 = entry.get('base64dQuery')
+                existing[b64_queries[b64]] = entry.id
+        return existing
+
+    def _write(self, pending: dict):
+        """検索回数を書き込む。書き込めたクエリは pending から削除する"""
+        from google.api_core.exceptions import AlreadyExists
+        firestore = firestore_module()
+
+        client = self.get_client()
+        col = client.collection(self.collection)
+        # 表記ゆれのあるクエリは同じドキュメントにまとめる
+        # doc_id -> [検索回数, 登録するときのクエリ, 元のクエリのリスト]
+        grouped = {}
+        for search_query, n in pending.items():
+            doc_id = query_document_id(search_query)
+            entry = grouped.setdefault(doc_id, [0, search_query, []])
+            entry[0] += n
+            entry[2].append(search_query)
+
+        # ドキュメント ID はクエリから決まるので、存在確認は 1 回の get_all で済む
+        exists = set()
+        for snapshot in client.get_all([col.document(_) for _ in grouped]):
+            if snapshot.exists:
+                exists.add(snapshot.id)
+        # 移行が終わるまでは、移行前のエントリがあればそちらを更新する
+        legacy = self._find_legacy_entries(
+            col,
+            [
+                q
+                for doc_id, entry in grouped.items() if doc_id not in exists
+                for q in entry[2]
+            ],
+        )
+
+        now_ = int(time.time())
+        # 検索回数が変わったドキュメント（ランキングの更新に使う）
+        refs = []
+        # 加算する (ドキュメント, 検索回数, 元のクエリのリスト)
+        updates = []
+        for doc_id, (n, search_query, raw_queries) in grouped.items():
+            legacy_ids = [legacy[q] for q in raw_queries if q in legacy]
+            if doc_id in exists or legacy_ids:
+                ref = col.document(doc_id if doc_id in exists else legacy_ids[0])
+                updates.append((ref, n, raw_queries))
+                continue
+            # 初回の検索は count=0 で登録し、2 回目以降を数える
+            ref = col.document(doc_id)
+            try:
+                ref.create({
+                    'isUserQuery': True,
+                    'query': search_query,
+                    'base64dQuery': b64encode(search_query.encode()).decode(),
+                    'createdAt': now_,
+                    'updatedAt': now_,
+                    'count': n - 1,
+                })
+            except AlreadyExists:
+                # 他のプロセスが先に登録した（そちらが初回なので、こちらは全て加算する）
+                updates.append((ref, n, raw_queries))
+                continue
+            refs.append(ref)
+            for q in raw_queries:
+                del pending[q]
+
+        # 500 件ごとのバッチで加算する。コミットできたバッチの分だけ pending から削除する
+        for i in range(0, len(updates), _max_batch_writes):
+            chunk = updates[i:i + _max_batch_writes]
+            batch = client.batch()
+            for ref, n, _ in chunk:
+                batch.update(
+                    ref,
+                    dict(
+                        count=firestore.Increment(n),
+                        updatedAt=now_,
+                    )
+                )
+            batch.commit()
+            for ref, _, raw_queries in chunk:
+                refs.append(ref)
+                for q in raw_queries:
+                    del pending[q]
+
+        # 検索回数は書き込み済みなので、ランキングの更新に失敗しても持ち越さない
+        try:
+            update_leaderboard(client, refs, collection=self.collection)
+        except Exception as e:
+            logger.error('ERROR in leaderboard update: %s', e)
+            with self._lock:
+                self._stats['leaderboard_errors'] += 1
+
+    def stop(self):
+        """バックグラウンドの書き込みを止め、残っている検索回数を書き込む"""
+        self._stopped.set()
+        self._wake.set()
+        self.flush()
+
+    def install_shutdown_hooks(self):
+        """終了時に残りを書き込むようにする
+
+        SIGTERM のハンドラは ft.app が設定し直すので、ここでは設定しない（終了時の atexit で書き込む）
+        """
+        atexit.register(self.stop)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_queries'] = len(self._pending)
+        return stats
@@ -0,0 +1,13 @@
+import hashlib
+import unicodedata
+
+
+def normalize_query(search_query: str) -> str:
+    """全角/半角や前後・連続する空白の違いを吸収したクエリを返す"""
+    tmp = unicodedata.normalize('NFKC', search_query)
+    return ' '.join(tmp.split())
+
+
+def query_document_id(search_query: str) -> str:
+    """Queries コレクションのドキュメント ID（正規化したクエリのハッシュ）"""
+    return hashlib.sha256(normalize_query(search_query).encode()).hexdigest()
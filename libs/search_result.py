@@ -0,0 +1,50 @@
+class SearchResult:
+    """検索結果 1 件（dict より小さく、属性の参照も速い）
+
+    これまでの dict と同じように entry['title'] / entry.get('source') でも参照できる
+    """
+
+    __slots__ = (
+        # タイトル
+        'title',
+        # リンク先
+        'link',
+        # 顧客名
+        'customer',
+        # 抽出
+        'extractive_segment',
+        # スニペット文字列
+        'snippet',
+        # スニペットを取得できたかどうか
+        'snippet_status',
+        # source（CLOUD_STORAGE / GOOGLE_DRIVE）
+        'source',
+    )
+
+    def __init__(self, title, link, customer, extractive_segment,
+                 snippet, snippet_status, source):
+        self.title = title
+        self.link = link
+        self.customer = customer
+        self.extractive_segment = extractive_segment
+        self.snippet = snippet
+        self.snippet_status = snippet_status
+        self.source = source
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> dict:
+        """JSON で返すとき用"""
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return 'SearchResult({})'.format(
+            ', '.join('{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__)
+        )
@@ -0,0 +1,166 @@
+import contextvars
+import os
+import threading
+
+from libs.metrics import metrics
+
+# 同じクエリの検索・要約の生成をまとめる settings
+global_single_flight_settings = {
+    'enabled': os.environ.get('SINGLE_FLIGHT_ENABLED', '1') == '1',
+}
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'abandoned')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # 呼び出したスレッドが Exception 以外（KeyboardInterrupt など）で中断した
+        self.abandoned = False
+
+
+class _Stream:
+    __slots__ = ('cond', 'chunks', 'done', 'error')
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新たに実行せずにその結果を待って共有する
+
+    - 例外はその時に待っていた全員に送られ、次の呼び出しは改めて実行する
+    - 実行していたスレッドが中断した場合は、待っていたスレッドの 1 つが実行し直す
+    - 結果は保持しない（キャッシュは呼び出し側で行う）
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self._stats = {
+            'leaders': 0,
+            'followers': 0,
+            'errors': 0,
+            'abandoned': 0,
+        }
+
+    def _count(self, role: str):
+        with self._lock:
+            self._stats[role + 's'] += 1
+        metrics.inc(
+            'single_flight_calls_total',
+            '同じ処理をまとめた呼び出し数（follower が実行を省略した数）',
+            flight=self.name,
+            role=role,
+        )
+
+    def do(self, key, fn):
+        """fn() の結果を返す。同じ key の fn が実行中ならその結果を待つ"""
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+            if not leader:
+                self._count('follower')
+                call.done.wait()
+                if call.abandoned:
+                    # 実行していたスレッドが中断したので実行し直す
+                    continue
+                if call.error is not None:
+                    raise call.error
+                return call.result
+
+            self._count('leader')
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+                with self._lock:
+                    self._stats['errors'] += 1
+            except BaseException:
+                call.abandoned = True
+                with self._lock:
+                    self._stats['abandoned'] += 1
+                raise
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                call.done.set()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def stream(self, key, fn):
+        """fn() が返すイテレータの要素を順に yield する。同じ key の実行中なら途中から合流する
+
+        fn() の読み出しは専用のスレッドで行うので、呼び出し側が途中でやめても
+        他の呼び出し側には最後まで届く
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._streams[key] = _Stream()
+        self._count('leader' if leader else 'follower')
+        if leader:
+            # ログのリクエスト ID などを引き継ぐ
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run,
+                args=(self._pump, key, shared, fn),
+                name='single-flight-{}'.format(self.name),
+                daemon=True,
+            ).start()
+
+        position = 0
+        while True:
+            with shared.cond:
+                while position >= len(shared.chunks) and not shared.done:
+                    shared.cond.wait()
+                chunks = shared.chunks[position:]
+                position = len(shared.chunks)
+                done = shared.done
+                error = shared.error
+            yield from chunks
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    def _pump(self, key, shared: _Stream, fn):
+        error = None
+        try:
+            for chunk in fn():
+                with shared.cond:
+                    shared.chunks.append(chunk)
+                    shared.cond.notify_all()
+        except Exception as e:
+            error = e
+            with self._lock:
+                self._stats['errors'] += 1
+        finally:
+            with self._lock:
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+            with shared.cond:
+                shared.error = error
+                shared.done = True
+                shared.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls) + len(self._streams)
+        total = stats['leaders'] + stats['followers']
+        stats['coalesced_ratio'] = stats['followers'] / total if total else 0.0
+        return stats
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# 要約キャッシュの settings
+global_summary_cache_settings = {
+    'enabled': os.environ.get('SUMMARY_CACHE_ENABLED', '1') == '1',
+    # アプリのディレクトリの外に置く（flet run -r はディレクトリ内の変更でアプリを再起動するため）
+    'path': os.environ.get('SUMMARY_CACHE_PATH') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or tempfile.gettempdir(),
+        'vertex-ai-search-demo',
+        'summary_cache.sqlite3',
+    ),
+    # 件数の上限。超えたら最後に使われたのが古いものから削除する
+    'max_entries': int(os.environ.get('SUMMARY_CACHE_MAX_ENTRIES', 5000)),
+    # 有効期限（秒）
+    'max_age_seconds': int(os.environ.get('SUMMARY_CACHE_MAX_AGE_SECONDS', 7 * 24 * 3600)),
+    # 何回書き込むごとに削除処理（と最終参照時刻の書き込み）を行うか
+    'evict_interval': 50,
+}
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS summaries (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS summaries_accessed_at ON summaries (accessed_at);
+CREATE INDEX IF NOT EXISTS summaries_created_at ON summaries (created_at);
+'''[1:]
+
+
+def prompt_fingerprint(model_name: str, config: dict, prompt: str) -> str:
+    """モデル名・生成設定・プロンプトのハッシュ"""
+    payload = json.dumps(
+        [model_name, config, prompt],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SummaryCache:
+    """SQLite に要約を保存するキャッシュ
+
+    接続はスレッドごとに持ち、WAL モードで複数セッション・複数プロセスから読み書きできるようにする
+    """
+
+    def __init__(self, path: str, max_entries: int, max_age_seconds: int,
+                 evict_interval: int = 50):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.evict_interval = evict_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        # 読み出した key と時刻。読み出しのたびには書き込まず、削除処理の前にまとめて反映する
+        self._accessed = {}
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_schema)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def get(self, key: str):
+        """保存された要約を返す。無い / 期限切れの場合は None"""
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            'SELECT value, created_at FROM summaries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[1] < now - self.max_age_seconds:
+            self._count('misses')
+            return None
+        with self._lock:
+            self._accessed[key] = now
+            self._stats['hits'] += 1
+        return row[0]
+
+    def set(self, key: str, model_name: str, value: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO summaries '
+            '(key, model, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (key, model_name, value, now, now),
+        )
+        self._count('writes')
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.evict_interval == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """期限切れのものと、件数上限を超えた古いものを削除する"""
+        conn = self._connect()
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            conn.executemany(
+                'UPDATE summaries SET accessed_at = ? WHERE key = ?',
+                [(t, k) for k, t in accessed.items()],
+            )
+        deleted = conn.execute(
+            'DELETE FROM summaries WHERE created_at < ?',
+            (time.time() - self.max_age_seconds,),
+        ).rowcount
+        deleted += conn.execute(
+            'DELETE FROM summaries WHERE key IN ('
+            'SELECT key FROM summaries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,),
+        ).rowcount
+        self._count('evictions', deleted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self._connect().execute(
+            'SELECT COUNT(*) FROM summaries'
+        ).fetchone()[0]
+        return stats
+
+
+_summary_cache = None
+_summary_cache_lock = threading.Lock()
+
+
+def get_summary_cache():
+    """プロセスで共有する SummaryCache を返す。無効化されている場合は None"""
+    global _summary_cache
+    if not global_summary_cache_settings['enabled']:
+        return None
+    if _summary_cache is None:
+        with _summary_cache_lock:
+            if _summary_cache is None:
+                _summary_cache = SummaryCache(
+                    path=global_summary_cache_settings['path'],
+                    max_entries=global_summary_cache_settings['max_entries'],
+                    max_age_seconds=global_summary_cache_settings['max_age_seconds'],
+                    evict_interval=global_summary_cache_settings['evict_interval'],
+                )
+    return _summary_cache
@@ -0,0 +1,58 @@
+import math
+import os
+
+# 検索結果の一覧の settings
+global_virtual_list_settings = {
+    # 検索結果 1 件の高さ（px）。一覧の項目はすべてこの高さにする
+    'item_extent': int(os.environ.get('RESULT_ITEM_EXTENT', 220)),
+    # 一覧の表示領域の高さ（px）
+    'viewport': int(os.environ.get('RESULT_LIST_HEIGHT', 880)),
+    # 表示領域の前後に余分に作っておく件数
+    'overscan': int(os.environ.get('RESULT_LIST_OVERSCAN', 2)),
+}
+
+
+class VirtualWindow:
+    """高さが一定の項目を並べた一覧のうち、コントロールを作る範囲 [start, end) を決める
+
+    範囲外の項目は上下の余白（spacer）の高さで置き換えるので、スクロールの長さは全件分のまま変わらない。
+    """
+
+    def __init__(self, item_extent: int = None, viewport: int = None, overscan: int = None):
+        self.item_extent = item_extent or global_virtual_list_settings['item_extent']
+        self.viewport = viewport or global_virtual_list_settings['viewport']
+        if overscan is None:
+            overscan = global_virtual_list_settings['overscan']
+        self.overscan = overscan
+        self.count = 0
+        self.pixels = 0.0
+        self.start = 0
+        self.end = 0
+
+    def move(self, pixels: float = None, count: int = None) -> bool:
+        """スクロール位置・件数を更新して範囲を計算し直す。範囲が変わったら True"""
+        if pixels is not None:
+            self.pixels = max(pixels, 0.0)
+        if count is not None:
+            self.count = count
+        first = int(self.pixels // self.item_extent)
+        visible = math.ceil(self.viewport / self.item_extent) + 1
+        start = min(max(first - self.overscan, 0), self.count)
+        end = min(first + visible + self.overscan, self.count)
+        changed = (start, end) != (self.start, self.end)
+        self.start, self.end = start, end
+        return changed
+
+    @property
+    def top(self) -> int:
+        """範囲より前の項目の高さの合計"""
+        return self.start * self.item_extent
+
+    @property
+    def bottom(self) -> int:
+        """範囲より後の項目の高さの合計"""
+        return (self.count - self.end) * self.item_extent
+
+    def height(self, extra: int = 0) -> int:
+        """一覧の高さ。全件の高さ（と末尾に付け足す extra）が表示領域より高ければ表示領域の高さ"""
+        return min(self.count * self.item_extent + extra, self.viewport)
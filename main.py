@@ -1,12 +1,23 @@
 import os
+import socket
+import threading
+import time
 
 import flet as ft
 
-from libs.gcp_libs import (add_or_update_entry, clean_snippet_text,
-                           clean_summary_text, exec_search_by_curl,
-                           generate_text, get_histories,
-                           get_histories_by_count, get_recommendations,
-                           parse_result_by_curl, prompt_base)
+from libs import page_meter
+from libs.extractive_summary import extractive_summary
+from libs.gcp_libs import (add_or_update_entry, generate_text_stream,
+                           get_histories, get_histories_by_count,
+                           global_search_settings, query_counter,
+                           search_and_parse, warm_up)
+from libs.log import get_logger, start_request, use_request
+from libs.markup import SummaryTokenizer, tokenize_snippet, tokenize_summary
+from libs.metrics import global_metrics_settings, metrics, start_metrics_server
+from libs.prompt import build_prompt
+from libs.virtual_list import VirtualWindow, global_virtual_list_settings
+
+logger = get_logger('main')
 
 google_color = {
     'primary_blue': '#4285F4',
@@ -21,19 +32,26 @@ google_color = {
 global_design_settings = {
     'result_horizontal_margin': 64,
     'result_vertical_margin': 5,
+    # 要約のストリーミング中に画面を更新する最短の間隔（秒）
+    'stream_update_interval': 0.1,
+    # 下端までの距離がこれ（px）を下回るまでスクロールしたら続きの検索結果を読み込む
+    'load_more_threshold': 400,
+    # 検索結果のカードのスニペットの最大行数（タイトルの行を含む）
+    'result_max_lines': 4,
+    # 「さらに表示」の行の高さ（px）
+    'more_results_height': 64,
 }
 
 def main(page: ft.Page):
-    def remove_all():
-        for _ in range(0, len(page.controls)):
-            page.controls.pop()
-
-    def render_main():
-        # History
+    def render_histories():
+        """検索履歴のボタンだけを作り直す。履歴が変わっていなければ何もしない"""
         histories = get_histories()
+        queries = tuple(history['query'] for history in histories[0:6])
+        if history_area.data == queries:
+            return False
+        history_area.data = queries
         histories_container = []
-        for i, history in enumerate(histories):
-            q = history['query']
+        for q in queries:
             display_q = q
             # 15 文字以上の場合は、表示を ... にする
             if len(display_q) > 15:
@@ -58,10 +76,8 @@ def main(page: ft.Page):
                     on_click=click_history,
                 )
             )
-            if i == 5:
-                break
         # 3行ずつに揃える
-        histories_area = [
+        history_area.controls = [
             ft.Row(
                 histories_container[0:3],
                 alignment=ft.MainAxisAlignment.CENTER,
@@ -71,33 +87,31 @@ def main(page: ft.Page):
                 alignment=ft.MainAxisAlignment.CENTER,
             ),
         ]
+        return True
 
-        # メインコンポーネントの描画
-        page.controls.append(
+    def render_main():
+        """ページの骨組み。一度だけ作り、以降は履歴・状態・検索結果の領域だけを更新する"""
+        render_histories()
+        page.controls.extend([
             ft.Column(
                 controls=[header_field],
-            )
-        )
-        page.controls.append(
+            ),
             ft.Row(
                 [eyecatch_image],
                 alignment=ft.MainAxisAlignment.CENTER,
-            )
-        )
-        page.controls.append(histories_area[0])
-        page.controls.append(histories_area[1])
-        page.controls.append(
+            ),
+            history_area,
             ft.Row(
                 [text_field],
                 alignment=ft.MainAxisAlignment.CENTER,
-            )
-        )
-        page.controls.append(
+            ),
             ft.Row(
                 [button_field],
                 alignment=ft.MainAxisAlignment.CENTER,
-            )
-        )
+            ),
+            status_area,
+            results_area,
+        ])
 
     def open_faq(e):
         # faq url
@@ -194,36 +208,407 @@ def main(page: ft.Page):
             return
         history_query = e.control.data
         text_field.value = history_query
-        page.update()
+        update_page(text_field)
         add_clicked(e)
 
+    def result_item(entry):
+        """検索結果 1 件とスニペットの span。スニペットを解釈できなければ None"""
+        snippet = entry['snippet']
+        # これだと長すぎなので Trim が必要
+        # snippet = entry['extractive_segment']
+        if entry['snippet_status'] != "SUCCESS":
+            snippet = 'このページの概要は提供されていません。'
+        try:
+            return entry, tokenize_snippet(snippet)
+        except Exception as e:
+            # パースに失敗したら結果に表示しない
+            logger.error('ERROR in snippet parse: %s', e)
+            return None
+
+    def result_row(item):
+        """検索結果 1 件のカード。高さは一覧の項目の高さ（item_extent）に揃える"""
+        entry, snippet_spans = item
+        spans = [
+            ft.TextSpan(
+                entry['title'] + "\n",
+                ft.TextStyle(
+                    weight=ft.FontWeight.BOLD,
+                    color=google_color['primary_blue'],
+                ),
+            )
+        ]
+        spans.extend(text_span(_) for _ in snippet_spans)
+        icon = ft.icons.PICTURE_AS_PDF
+        color = 'red'
+        if entry.get('source') == 'GOOGLE_DRIVE':
+            icon = ft.icons.ADD_TO_DRIVE
+            color = 'blue'
+        card = ft.Card(
+            content=ft.Container(
+                content=ft.Column(
+                    [
+                        ft.ListTile(
+                            leading=ft.Icon(icon, color=color),
+                            # 検索結果のタイトルと説明文のフォントサイズ
+                            # title=ft.Text(entry['title'], size=24),
+                            title=ft.Text(entry['customer'], size=24, max_lines=1),
+                            subtitle=ft.Text(
+                                spans=spans,
+                                size=16,
+                                # 項目の高さに収まるように省略する
+                                max_lines=global_design_settings['result_max_lines'],
+                                overflow=ft.TextOverflow.ELLIPSIS,
+                            )
+                        ),
+                        ft.Row(
+                            [
+                                ft.ElevatedButton(
+                                    content=ft.Row(
+                                        [
+                                            ft.Icon(
+                                                name=ft.icons.OPEN_IN_NEW,
+                                                color=google_color['primary_white']
+                                            ),
+                                            ft.Text("開く"),
+                                        ]
+                                    ),
+                                    data=entry['link'],
+                                    on_click=open_url,
+                                    color=google_color['primary_white'],
+                                    bgcolor=google_color['primary_blue']
+                                )
+                            ],
+                            alignment=ft.MainAxisAlignment.END
+                        )
+                    ]
+                ),
+                width=800,
+                padding=10,
+            ),
+            margin=ft.margin.symmetric(
+                vertical=global_design_settings['result_vertical_margin'],
+                horizontal=global_design_settings['result_horizontal_margin'],
+            ),
+        )
+        return ft.Container(
+            content=ft.ResponsiveRow(
+                [card],
+                alignment=ft.MainAxisAlignment.CENTER
+            ),
+            height=global_virtual_list_settings['item_extent'],
+        )
+
+    def result_list_view(search_query):
+        """検索結果の一覧。表示領域とその前後（overscan）のカードだけを作る"""
+        result_list = ft.ListView(
+            spacing=0,
+            on_scroll_interval=100,
+            data={
+                'query': search_query,
+                # (検索結果, スニペットの span)。カードはまだ作らない
+                'items': [],
+                # 作成済みのカード（位置 -> コントロール）。範囲内に残っていれば作り直さない
+                'rows': {},
+                'window': VirtualWindow(),
+                # 範囲外の項目の代わりの余白
+                'top': ft.Container(height=0),
+                'bottom': ft.Container(height=0),
+                'page_token': None,
+                # 「さらに表示」の行
+                'more': None,
+                # スクロールのイベントと続きの読み込みが別のスレッドで来る
+                'lock': threading.RLock(),
+            },
+        )
+        result_list.on_scroll = lambda e: result_list_on_scroll(result_list, e)
+        return result_list
+
+    def add_results(result_list, pd_result):
+        """検索結果（1 ページ分）を一覧の末尾に追加する"""
+        state = result_list.data
+        with state['lock']:
+            limit = global_search_settings['display_count'] - len(state['items'])
+            items = [_ for _ in map(result_item, pd_result['result']) if _ is not None]
+            state['items'].extend(items[:max(limit, 0)])
+            page_token = pd_result['meta'].get('next_page_token')
+            state['page_token'] = page_token if page_token and len(items) < limit else None
+            if state['more'] is not None:
+                state['more'].controls[0].disabled = False
+            render_results(result_list)
+
+    def render_results(result_list, pixels=None):
+        """範囲内のカードと上下の余白で一覧を組み立てる。スクロールしても範囲が変わらなければ False"""
+        state = result_list.data
+        with state['lock']:
+            window = state['window']
+            changed = window.move(pixels, len(state['items']))
+            if pixels is not None and not changed:
+                return False
+            rows = {}
+            for i in range(window.start, window.end):
+                rows[i] = state['rows'].get(i) or result_row(state['items'][i])
+            state['rows'] = rows
+            state['top'].height = window.top
+            state['bottom'].height = window.bottom
+            controls = [state['top'], *rows.values(), state['bottom']]
+            extra = 0
+            if state['page_token']:
+                if state['more'] is None:
+                    state['more'] = more_results_row(result_list)
+                controls.append(state['more'])
+                extra = global_design_settings['more_results_height']
+            result_list.controls = controls
+            result_list.height = window.height(extra)
+            return True
+
+    def more_results_row(result_list):
+        def on_click(e):
+            button.disabled = True
+            update_page(button)
+            # 検索は UI のハンドラの外で行う
+            page.run_thread(load_more_results, result_list)
+
+        button = ft.OutlinedButton("さらに表示", on_click=on_click)
+        return ft.Row(
+            [button],
+            alignment=ft.MainAxisAlignment.CENTER,
+            height=global_design_settings['more_results_height'],
+        )
+
+    def load_more(result_list):
+        # 「さらに表示」を押したときと同じく続きを読み込む
+        more = result_list.data['more']
+        if more is not None and result_list.data['page_token'] and not more.controls[0].disabled:
+            more.controls[0].on_click(None)
+
+    def result_list_on_scroll(result_list, e):
+        # 表示する範囲が変わったら、範囲に入ったカードと余白の高さだけを送る
+        if render_results(result_list, e.pixels):
+            update_page(result_list)
+        if e.pixels >= e.max_scroll_extent - global_design_settings['load_more_threshold']:
+            load_more(result_list)
+
+    def page_on_scroll(e):
+        # 一覧が表示領域より短い場合は、ページの下端の近くまでスクロールしたら続きを読み込む
+        if e.pixels < e.max_scroll_extent - global_design_settings['load_more_threshold']:
+            return
+        for control in results_area.controls:
+            if isinstance(control, ft.ListView):
+                load_more(control)
+
+    def load_more_results(result_list):
+        """次のページを検索して一覧に追加する"""
+        state = result_list.data
+        try:
+            pd_result = search_and_parse(state['query'], page_token=state['page_token'])
+        except Exception as e:
+            logger.error('ERROR in search (next page): %s', e)
+            # もう一度押せるようにする
+            state['more'].controls[0].disabled = False
+            update_page(state['more'])
+            return
+        add_results(result_list, pd_result)
+        # 読み込み中に次の検索が始まっていたら表示しない
+        if result_list in results_area.controls:
+            update_page(result_list)
+
+    def update_page(*controls):
+        # 画面の更新（websocket での送信）にかかった時間と送信量を記録する
+        # controls を指定した場合はそのコントロールの差分だけを送る
+        with metrics.span('page_update'), meter.measure():
+            page.update(*controls)
+
+    def log_page_updates(started_at):
+        # 検索 1 回分の画面更新の回数・送信量・時間
+        logger.info('PAGE_UPDATE search', extra={'fields': dict(
+            meter.snapshot(),
+            total_seconds=round(time.perf_counter() - started_at, 3),
+        )})
+
+    def text_span(span):
+        # libs.markup の (テキスト, 太字かどうか)
+        text, bold = span
+        if bold:
+            return ft.TextSpan(text, ft.TextStyle(weight=ft.FontWeight.BOLD))
+        return ft.TextSpan(text)
+
+    def recommendation_button(r):
+        return ft.Container(
+            content=ft.Text(
+                r,
+                color=google_color['primary_white'],
+                text_align=ft.TextAlign.CENTER
+            ),
+            margin=16,
+            padding=4,
+            alignment=ft.alignment.center,
+            bgcolor=google_color['primary_blue'],
+            width=296,
+            height=48,
+            border_radius=32,
+            ink=True,
+            # 元のクエリを保持
+            data=r,
+            on_click=click_history,
+        )
+
+    def summary_card(controls):
+        """要約を表示するカード"""
+        return ft.Card(
+            content=ft.Container(
+                bgcolor=google_color['tertiary_blue'],
+                content=ft.Column(controls),
+                width=800,
+                border_radius=5,
+                padding=10,
+            ),
+            margin=ft.margin.symmetric(
+                vertical=global_design_settings['result_vertical_margin'],
+                horizontal=global_design_settings['result_horizontal_margin'],
+            ),
+        )
+
+    def preview_row(preview, final):
+        """検索結果の抽出回答から作った要約のカード。final でなければ生成中であることも表示する"""
+        caption = "検索結果からの抜粋です。"
+        if not final:
+            caption += "要約を生成しています..."
+        return ft.ResponsiveRow(
+            [
+                summary_card([
+                    ft.Text(caption, size=12),
+                    ft.Text(
+                        size=20,
+                        spans=[text_span(_) for _ in tokenize_summary(preview)],
+                    ),
+                ])
+            ],
+            alignment=ft.MainAxisAlignment.CENTER
+        )
+
+    def stream_summary(prompt):
+        """要約をストリーミングで生成し、届いた分から要約カードに表示する"""
+        summary_text = ft.Text(size=20, spans=[])
+        recommendation_row = ft.Row(
+            [],
+            alignment=ft.MainAxisAlignment.CENTER,
+        )
+        card = summary_card([summary_text, recommendation_row])
+        summary_row = ft.ResponsiveRow(
+            [card],
+            alignment=ft.MainAxisAlignment.CENTER
+        )
+
+        parser = SummaryTokenizer()
+        # 確定した行の span。確定済みの行は作り直さない
+        spans = []
+        last_update = 0
+        # マークアップの解釈にかかった時間の合計
+        clean_seconds = 0
+        for chunk in generate_text_stream(prompt):
+            clean_started_at = time.perf_counter()
+            new_spans = parser.feed(chunk)
+            partial_spans = parser.partial()
+            clean_seconds += time.perf_counter() - clean_started_at
+            spans.extend(text_span(_) for _ in new_spans)
+            summary_text.spans = spans + [
+                text_span(_) for _ in partial_spans
+            ]
+            # おすすめワードの行が届いたらボタンを表示する
+            if parser.recommendations and not recommendation_row.controls:
+                recommendation_row.controls = [
+                    recommendation_button(r) for r in parser.recommendations
+                ]
+            now = time.monotonic()
+            if summary_row not in status_area.controls:
+                # 最初の chunk が届いたら抜粋の要約を生成した要約に置き換える
+                status_area.controls = [summary_row]
+                update_page(status_area)
+                last_update = now
+            elif now - last_update >= global_design_settings['stream_update_interval']:
+                update_page(card)
+                last_update = now
+
+        clean_started_at = time.perf_counter()
+        committed = len(spans)
+        all_spans = parser.close()
+        metrics.observe('summary_clean', clean_seconds + time.perf_counter() - clean_started_at)
+        # close() は最後の行を追加して末尾の改行を削るだけなので、確定済みの span はそのまま使う
+        summary_text.spans = spans[:len(all_spans)] + [
+            text_span(_) for _ in all_spans[committed:]
+        ]
+        if parser.recommendations and not recommendation_row.controls:
+            recommendation_row.controls = [
+                recommendation_button(r) for r in parser.recommendations
+            ]
+        return summary_row
+
+    def finish_search(search_query, prompt, preview, started_at, request):
+        """要約を生成して検索結果の上に表示する（UI のハンドラの外で実行する）"""
+        # 検索と同じリクエスト ID でログを出力する
+        use_request(request)
+        try:
+            summary_row = stream_summary(prompt)
+            if summary_row not in status_area.controls:
+                # テキストの chunk が 1 つも届かなかった（安全性のフィルタなど）
+                status_area.controls = [preview_row(preview, True)]
+                metrics.inc(
+                    'summary_fallback_total',
+                    '要約の生成に失敗して抜粋の要約を表示した回数',
+                    reason='EmptySummary',
+                )
+            else:
+                metrics.observe('search_to_summary', time.perf_counter() - started_at)
+                logger.info('LATENCY search_to_summary', extra={'fields': {
+                    'seconds': round(time.perf_counter() - started_at, 3),
+                }})
+        except Exception as e:
+            logger.exception('ERROR in summary: %s', e)
+            # 途中までの要約は消し、抜粋の要約を最終的な回答にする
+            status_area.controls = [preview_row(preview, True)]
+            metrics.inc(
+                'summary_fallback_total',
+                '要約の生成に失敗して抜粋の要約を表示した回数',
+                reason=type(e).__name__,
+            )
+        with metrics.span('history_write'):
+            add_or_update_entry(search_query)
+
+        text_field.disabled = False
+        button_field.disabled = False
+        # 要約の残りと入力欄、変わっていれば検索履歴だけを送る
+        controls = [text_field, button_field, status_area]
+        if render_histories():
+            controls.append(history_area)
+        update_page(*controls)
+        log_page_updates(started_at)
+
     def add_clicked(e):
         # クエリが空の場合は空振りさせる
         if not text_field.value:
             return
+        # 検索を開始した時刻（表示までの時間の計測に使う）
+        started_at = time.perf_counter()
+        request = start_request()
+        meter.reset()
         text_field.disabled = True
         button_field.disabled = True
-        remove_all()
-        render_main()
-        page.update()
-        page.controls.append(
-            ft.Row(
-                [
-                    ft.Image(
-                        src="/Gemini_icon_full-color-rgb@2x.png",
-                        width=16,
-                        height=16,
-                        fit=ft.ImageFit.CONTAIN,
-                    ),
-                    ft.Container(
-                        ft.Text(
-                            "生成しています...",
-                            size=12,
-                        ),
+        generating_row = ft.Row(
+            [
+                ft.Image(
+                    src="/Gemini_icon_full-color-rgb@2x.png",
+                    width=16,
+                    height=16,
+                    fit=ft.ImageFit.CONTAIN,
+                ),
+                ft.Container(
+                    ft.Text(
+                        "生成しています...",
+                        size=12,
                     ),
-                ],
-                alignment=ft.MainAxisAlignment.CENTER,
-            )
+                ),
+            ],
+            alignment=ft.MainAxisAlignment.CENTER,
         )
         # Loading の gif を表示
         loading_image = ft.Image(
@@ -234,228 +619,66 @@ def main(page: ft.Page):
             fit=ft.ImageFit.CONTAIN,
             border_radius=2,
         )
-        page.controls.append(
-            ft.Row(
-                [loading_image],
-                alignment=ft.MainAxisAlignment.CENTER,
-            )
+        loading_row = ft.Row(
+            [loading_image],
+            alignment=ft.MainAxisAlignment.CENTER,
         )
-        page.update()
+        status_area.controls = [generating_row, loading_row]
+        # 前の検索結果は消す
+        results_area.controls = []
+        update_page(text_field, button_field, status_area, results_area)
         # 検索実行
         search_query = text_field.value
-        search_response = exec_search_by_curl(
-            search_query=search_query,
-            )
         pd_result = {}
         try:
-            pd_result = parse_result_by_curl(search_response)
+            pd_result = search_and_parse(search_query)
         except Exception as e:
             pd_result = {}
-            print(e)
+            logger.error('ERROR in search: %s', e)
 
-        # 最終的にコントロールに追加するリスト
-        stacked_controls = []
         if not pd_result:
-            print("Error occured.")
-            stacked_controls.append(
+            logger.warning('Error occured.')
+            status_area.controls = []
+            results_area.controls.append(
                 ft.Row(
                     [
                         ft.Text("結果が取得できませんでした。他の検索ワードでお試しください。")
                     ]
                 )
             )
-        else:
-            prompt = prompt_base()
-            # 検索結果
-            for j, entry in enumerate(pd_result['result']):
-                snippet = entry['snippet']
-                # これだと長すぎなので Trim が必要
-                # snippet = entry['extractive_segment']
-                if entry['snippet_status'] != "SUCCESS":
-                    snippet = 'このページの概要は提供されていません。'
-                txts = []
-                try:
-                    txts = clean_snippet_text(snippet)
-                except Exception as e:
-                    print('ERROR:{}'.format(e))
-                # パースに失敗したら結果に表示しない
-                if not txts:
-                    continue
-                spans = []
-
-                spans.append(
-                    ft.TextSpan(
-                        entry['title'] + "\n",
-                        ft.TextStyle(
-                            weight=ft.FontWeight.BOLD,
-                            color=google_color['primary_blue'],
-                        ),
-                    )
-                )
-
-                for i in range(len(txts)):
-                    if i % 2 == 0:
-                        spans.append(
-                            ft.TextSpan(txts[i])
-                        )
-                    else:
-                        spans.append(
-                            ft.TextSpan(
-                                txts[i],
-                                ft.TextStyle(weight=ft.FontWeight.BOLD),
-                            )
-                        )
-                if j < 3:
-                    prompt += '''
-                {}, {}
-'''.format(
-        entry['customer'] if entry['source'] == 'GOOGLE_DRIVE' else entry['title'],
-        entry['link'],
-    )
-                icon = ft.icons.PICTURE_AS_PDF
-                color = 'red'
-                if entry.get('source') == 'GOOGLE_DRIVE':
-                    icon = ft.icons.ADD_TO_DRIVE
-                    color = 'blue'
-                card = ft.Card(
-                    content=ft.Container(
-                        content=ft.Column(
-                            [
-                                ft.ListTile(
-                                    leading=ft.Icon(icon, color=color),
-                                    # 検索結果のタイトルと説明文のフォントサイズ
-                                    # title=ft.Text(entry['title'], size=24),
-                                    title=ft.Text(entry['customer'], size=24),
-                                    subtitle=ft.Text(spans=spans, size=16)
-                                ),
-                                ft.Row(
-                                    [
-                                        ft.ElevatedButton(
-                                            content=ft.Row(
-                                                [
-                                                    ft.Icon(
-                                                        name=ft.icons.OPEN_IN_NEW,
-                                                        color=google_color['primary_white']
-                                                    ),
-                                                    ft.Text("開く"),
-                                                ]
-                                            ),
-                                            data=entry['link'],
-                                            on_click=open_url,
-                                            color=google_color['primary_white'],
-                                            bgcolor=google_color['primary_blue']
-                                        )
-                                    ],
-                                    alignment=ft.MainAxisAlignment.END
-                                )
-                            ]
-                        ),
-                        width=800,
-                        padding=10,
-                    ),
-                    margin=ft.margin.symmetric(
-                        vertical=global_design_settings['result_vertical_margin'],
-                        horizontal=global_design_settings['result_horizontal_margin'],
-                    ),
-                )
-                stacked_controls.append(
-                    ft.ResponsiveRow(
-                        [card],
-                        alignment=ft.MainAxisAlignment.CENTER
-                    )
-                )
-            prompt += '\n====='
-            summary = generate_text(prompt)
-            # stacked controls に要約を足す
-            spans = []
-            recommendations = []
-            try:
-                txts = clean_summary_text(summary)
-                recommendation_buttons = []
-                for r in get_recommendations(summary):
-                    recommendation_buttons.append(
-                        ft.Container(
-                            content=ft.Text(
-                                r,
-                                color=google_color['primary_white'],
-                                text_align=ft.TextAlign.CENTER
-                            ),
-                            margin=16,
-                            padding=4,
-                            alignment=ft.alignment.center,
-                            bgcolor=google_color['primary_blue'],
-                            width=296,
-                            height=48,
-                            border_radius=32,
-                            ink=True,
-                            # 元のクエリを保持
-                            data=r,
-                            on_click=click_history,
-                        )
-                        # ft.TextButton(
-                        #     r,
-                        #     data=r,
-                        #     on_click=click_history,
-                        # )
-                    )
-
-                for i in range(len(txts)):
-                    txt = txts[i]
-                    if txt.startswith('[BOLD]'):
-                        txt = txt.split('[BOLD]')[1:][0]
-                        spans.append(
-                            ft.TextSpan(
-                                txt,
-                                ft.TextStyle(weight=ft.FontWeight.BOLD),
-                            )
-                        )
-                    else:
-                        spans.append(ft.TextSpan(txt))
-                summary_card = ft.Card(
-                    content=ft.Container(
-                        bgcolor=google_color['tertiary_blue'],
-                        content=ft.Column(
-                            [
-                                ft.Text(
-                                    size=20,
-                                    spans=spans,
-                                ),
-                                ft.Row(
-                                    recommendation_buttons,
-                                    alignment=ft.MainAxisAlignment.CENTER,
-                                )
-                            ]
-                        ),
-                        width=800,
-                        border_radius=5,
-                        padding=10,
-                    ),
-                    margin=ft.margin.symmetric(
-                        vertical=global_design_settings['result_vertical_margin'],
-                        horizontal=global_design_settings['result_horizontal_margin'],
-                    ),
-                )
-                stacked_controls = [
-                    ft.ResponsiveRow(
-                        [summary_card],
-                        alignment=ft.MainAxisAlignment.CENTER
-                    )
-                ] + stacked_controls
-            except Exception as e:
-                print('ERROR{}'.format(str(e)))
-            add_or_update_entry(search_query)
+            text_field.disabled = False
+            button_field.disabled = False
+            # 表示
+            update_page(text_field, button_field, status_area, results_area)
+            log_page_updates(started_at)
+            return
 
-        # 再描画
-        remove_all()
-        render_main()
-        for _ in stacked_controls:
-            page.controls.append(_)
+        with metrics.span('prompt_build'):
+            prompt = build_prompt(pd_result, search_query)
+        # 生成を待つ間は、Loading の gif の代わりに検索結果の抽出回答から作った要約を「生成しています...」の下に表示する
+        with metrics.span('extractive_summary'):
+            preview = extractive_summary(pd_result, search_query)
+        status_area.controls = [generating_row, preview_row(preview, False)]
+        # 検索結果（カードは表示する範囲の分だけ作る）
+        result_list = result_list_view(search_query)
+        add_results(result_list, pd_result)
+        results_area.controls.append(result_list)
 
-        text_field.disabled = False
-        button_field.disabled = False
-        # 表示
-        page.update()
-        # print(prompt)
+        # 要約を待たずに抜粋の要約と検索結果を表示する
+        update_page(status_area, results_area)
+        metrics.observe('search_to_first_card', time.perf_counter() - started_at)
+        logger.info('LATENCY search_to_first_card', extra={'fields': {
+            'seconds': round(time.perf_counter() - started_at, 3),
+        }})
+        # 要約の生成は別スレッドで行い、生成できたら検索結果の上に表示する
+        page.run_thread(
+            finish_search,
+            search_query,
+            prompt,
+            preview,
+            started_at,
+            request,
+        )
 
     # Main
     page.theme_mode = ft.ThemeMode.LIGHT
@@ -469,6 +692,10 @@ def main(page: ft.Page):
         font_family="GoogleNotoSansJp"
     )
     page.scroll = "always"
+    page.on_scroll_interval = 200
+    page.on_scroll = page_on_scroll
+    # 画面更新の回数・送信量の計測
+    meter = page_meter.attach(page)
 
     # Header
     header_field = ft.Container(
@@ -566,10 +793,39 @@ def main(page: ft.Page):
         ]
     )
     # page.appbar = appbar
+    # 検索履歴のボタン（2 行）
+    history_area = ft.Column([])
+    # 生成中の表示と要約カード
+    status_area = ft.Column([])
+    # 検索結果の一覧（またはエラーの表示）
+    results_area = ft.Column([])
     render_main()
     page.update()
 
 
+def start_warm_up(port: int):
+    """サーバーが接続を受け付け始めてから warm_up() を実行する"""
+    def run():
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        warm_up()
+
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
+
+
+# 終了時に溜まっている検索回数を書き込む
+query_counter.install_shutdown_hooks()
+# /metrics を別のポートで公開する
+if global_metrics_settings['port']:
+    start_metrics_server(global_metrics_settings['port'])
+# 起動後にクライアントの初期化などを済ませておく
+if os.environ.get('WARMUP_ON_START', '1') == '1':
+    start_warm_up(int(os.environ.get('FLET_SERVER_PORT', 8080)))
+
 app = ft.app(
     target=main,
     assets_dir="assets",
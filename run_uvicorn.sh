@@ -1,4 +1,5 @@
 # for local
 . .env
 # python main.py
-hypercorn main:app --bind 0.0.0.0:8080
+# 検索 API（api.py）を起動する。Flet の UI は run.sh / run_local.sh で起動する
+hypercorn api:app --bind 0.0.0.0:8080 --workers ${API_WORKERS:-4}